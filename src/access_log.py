@@ -0,0 +1,239 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Structured access log and diagnostic messages for the Web server,
+written by a background thread so that logging stays off the request path.
+
+Request threads and coroutines only append raw records to a queue;
+the writer thread formats them (Common, Combined or JSON lines),
+and writes each batch with a single write() call.
+Log files are rotated by size, and a file rotated away by another
+process (e.g. a sibling pre-forked worker) is reopened.
+"""
+
+import json
+import os
+import queue
+import random
+import sys
+import threading
+import time
+from dataclasses import dataclass
+from typing import TextIO
+
+LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+FORMATS = ("common", "combined", "json")
+
+
+@dataclass(slots=True)
+class AccessRecord:
+    """
+    What is known about one served request, before formatting.
+    """
+
+    time: float
+    client: str
+    request_line: str
+    status: int
+    length: int
+    referer: str
+    user_agent: str
+    duration: float
+
+
+class LogFile:
+    """
+    A log destination: a standard stream, or a file rotated by size.
+    """
+
+    def __init__(self, path: str, max_bytes: int, backups: int) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.stream: TextIO = sys.stdout
+        if path == "-":
+            return
+        if path == "stderr":
+            self.stream = sys.stderr
+            return
+        self.stream = open(path, "a", encoding="utf-8")
+
+    def write(self, text: str) -> None:
+        if self.path not in ("-", "stderr"):
+            self._check_rotation()
+        self.stream.write(text)
+        self.stream.flush()
+
+    def _check_rotation(self) -> None:
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            self._reopen()
+            return
+        # Another process rotated the file away: follow the new one
+        if st.st_ino != os.fstat(self.stream.fileno()).st_ino:
+            self._reopen()
+        elif self.max_bytes and st.st_size >= self.max_bytes:
+            # access.log.1 is the newest backup, access.log.N the oldest
+            for index in range(self.backups - 1, 0, -1):
+                older = f"{self.path}.{index}"
+                if os.path.exists(older):
+                    os.replace(older, f"{self.path}.{index + 1}")
+            if self.backups:
+                os.replace(self.path, f"{self.path}.1")
+            else:
+                os.remove(self.path)
+            self._reopen()
+
+    def _reopen(self) -> None:
+        self.stream.close()
+        self.stream = open(self.path, "a", encoding="utf-8")
+
+
+def format_record(record: AccessRecord, log_format: str) -> str:
+    if log_format == "json":
+        return json.dumps(
+            {
+                "time": round(record.time, 3),
+                "client": record.client,
+                "request": record.request_line,
+                "status": record.status,
+                "bytes": record.length,
+                "referer": record.referer,
+                "user_agent": record.user_agent,
+                "duration_ms": round(record.duration * 1000, 3),
+            }
+        )
+    stamp = time.strftime("%d/%b/%Y:%H:%M:%S %z", time.localtime(record.time))
+    line = (
+        f'{record.client} - - [{stamp}] "{record.request_line}" '
+        f"{record.status} {record.length or '-'}"
+    )
+    if log_format == "combined":
+        line += f' "{record.referer or "-"}" "{record.user_agent or "-"}"'
+    return line
+
+
+class AccessLog:
+    """
+    Queues access records and messages for the background writer thread.
+    """
+
+    def __init__(
+        self,
+        path: str = "-",
+        log_format: str = "combined",
+        level: str = "info",
+        sample: float = 1.0,
+        max_bytes: int = 0,
+        backups: int = 5,
+        batch_size: int = 256,
+        flush_interval: float = 0.2,
+    ) -> None:
+        self.log_format = log_format
+        self.level = LEVELS[level]
+        self.sample = sample
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # SimpleQueue is implemented in C and never blocks a producer
+        self._queue: "queue.SimpleQueue[AccessRecord | tuple[int, str] | None]" = (
+            queue.SimpleQueue()
+        )
+        self._access = LogFile(path, max_bytes, backups)
+        self._messages = LogFile("stderr", 0, 0)
+        # Started on first use, in the process (e.g. pre-forked worker) using it
+        self._writer: threading.Thread | None = None
+        self._start_lock = threading.Lock()
+
+    def _put(self, item: "AccessRecord | tuple[int, str] | None") -> None:
+        if self._writer is None:
+            with self._start_lock:
+                if self._writer is None:
+                    self._writer = threading.Thread(target=self._run, daemon=True)
+                    self._writer.start()
+        self._queue.put(item)
+
+    def access(
+        self,
+        client: str,
+        request_line: str,
+        status: int,
+        length: int,
+        referer: str,
+        user_agent: str,
+        duration: float,
+    ) -> None:
+        """
+        Records one served request. Successful requests are sampled;
+        errors (status 400 and up) are always kept.
+        """
+        if status < 400 and self.sample < 1.0 and random.random() >= self.sample:
+            return
+        self._put(
+            AccessRecord(
+                time.time(),
+                client,
+                request_line,
+                status,
+                length,
+                referer,
+                user_agent,
+                duration,
+            )
+        )
+
+    def message(self, level: str, text: str) -> None:
+        if LEVELS[level] >= self.level:
+            self._put((LEVELS[level], text))
+
+    def debug(self, text: str) -> None:
+        self.message("debug", text)
+
+    def info(self, text: str) -> None:
+        self.message("info", text)
+
+    def warning(self, text: str) -> None:
+        self.message("warning", text)
+
+    def close(self) -> None:
+        """
+        Writes out everything queued so far and stops the writer.
+        """
+        if self._writer is not None:
+            self._queue.put(None)
+            self._writer.join()
+
+    def _run(self) -> None:
+        names = {value: name.upper() for name, value in LEVELS.items()}
+        running = True
+        while running:
+            # Wait for one item, then gather whatever else arrives shortly after
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(
+                        self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                    )
+                except queue.Empty:
+                    break
+
+            access_lines: list[str] = []
+            message_lines: list[str] = []
+            for item in batch:
+                if item is None:
+                    running = False
+                elif isinstance(item, AccessRecord):
+                    access_lines.append(format_record(item, self.log_format))
+                else:
+                    level, text = item
+                    message_lines.append(f"{names[level]} {text}")
+
+            try:
+                if access_lines:
+                    self._access.write("\n".join(access_lines) + "\n")
+                if message_lines:
+                    self._messages.write("\n".join(message_lines) + "\n")
+            except OSError as e:
+                # Never let a full disk or closed pipe kill the writer
+                print(f"Access log write failed: {e}", file=sys.stderr)
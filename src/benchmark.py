@@ -0,0 +1,343 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Load generator and latency benchmark for web_server.py.
+
+Starts the server on a scratch copy of the test pages plus generated blobs,
+drives it from concurrent client threads, and prints the results as JSON,
+so runs on different commits can be compared.
+
+Run with the following optional command line parameters:
+python3 benchmark.py [--concurrency N] [--duration SECONDS] [--no-keepalive]
+                     [--mix html:90,1M:9,8M:1] [--blockers N]
+                     [--port PORT] [--output FILE] [-- SERVER ARGS...]
+
+Examples:
+$ python3 src/benchmark.py --concurrency 32 --duration 10
+$ python3 src/benchmark.py --blockers 200 -- --mode async --max-connections-per-ip 0
+$ python3 src/benchmark.py --mix 4M:1 --no-keepalive --output before.json
+
+--mix is a weighted list of what to request: "html" is one of the pages
+in tests/web_files, and a size such as 64K or 8M is a generated blob.
+--blockers opens that many idle connections first, like src/blocker.py.
+They all come from 127.0.0.1, as do the clients, so lift the server's
+per-IP connection limit when using more than it allows.
+Anything after "--" is passed to the server.
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from http_parser import ResponseParser
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+WEB_FILES = os.path.join(os.path.dirname(SRC_DIR), "tests", "web_files")
+SIZE_SUFFIXES = {"K": 1024, "M": 1024 * 1024, "G": 1024 * 1024 * 1024}
+
+
+def parse_size(text: str) -> int:
+    suffix = text[-1:].upper()
+    if suffix in SIZE_SUFFIXES:
+        return int(float(text[:-1]) * SIZE_SUFFIXES[suffix])
+    return int(text)
+
+
+def prepare_files(root: str, mix: str) -> list[tuple[list[str], int]]:
+    """
+    Fills the server's directory with the test pages and the blobs named
+    in the mix. Returns, for each mix entry, the paths to pick from and
+    the entry's weight.
+    """
+    pages_dir = os.path.join(root, "tests", "web_files")
+    shutil.copytree(WEB_FILES, pages_dir)
+    pages = [f"/tests/web_files/{name}" for name in sorted(os.listdir(pages_dir))]
+
+    choices: list[tuple[list[str], int]] = []
+    for item in mix.split(","):
+        name, _, weight = item.partition(":")
+        if name == "html":
+            choices.append((pages, int(weight or 1)))
+            continue
+        size = parse_size(name)
+        blob = f"blob-{size}.bin"
+        with open(os.path.join(root, blob), "wb") as f:
+            remaining = size
+            while remaining:
+                chunk = os.urandom(min(remaining, 1024 * 1024))
+                f.write(chunk)
+                remaining -= len(chunk)
+        choices.append(([f"/{blob}"], int(weight or 1)))
+    return choices
+
+
+def process_rss_kb(pid: int) -> int:
+    """
+    Resident memory of a process and all its descendants (pre-forked
+    workers included), from /proc; 0 where /proc is not available.
+    """
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            rss = sum(int(line.split()[1]) for line in f if line.startswith("VmRSS:"))
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            children = [int(child) for child in f.read().split()]
+    except (OSError, ValueError):
+        return 0
+    return rss + sum(process_rss_kb(child) for child in children)
+
+
+class Results:
+    """
+    Measurements shared by the client threads.
+    """
+
+    def __init__(self) -> None:
+        self.latencies: list[float] = []
+        self.errors = 0
+        self.bytes_received = 0
+        self.lock = threading.Lock()
+
+    def record(self, latency: float, length: int) -> None:
+        with self.lock:
+            self.latencies.append(latency)
+            self.bytes_received += length
+
+    def fail(self) -> None:
+        with self.lock:
+            self.errors += 1
+
+
+def fetch(
+    conn: socket.socket, parser: ResponseParser, path: str, keep_alive: bool
+) -> tuple[int, bool]:
+    """
+    Sends one GET and reads the whole response. Returns the body length,
+    and whether the server will keep the connection open.
+    """
+    connection = "keep-alive" if keep_alive else "close"
+    request = f"GET {path} HTTP/1.1\r\nHost: bench\r\nConnection: {connection}\r\n\r\n"
+    conn.sendall(request.encode())
+
+    head = parser.next_response()
+    while head is None:
+        data = conn.recv(65536)
+        if not data:
+            raise ConnectionError("server closed the connection")
+        parser.feed(data)
+        head = parser.next_response()
+    if head.status >= 500:
+        raise ConnectionError(f"server answered {head.status}")
+
+    # Count the body off without keeping it
+    remaining = int(head.headers.get("content-length", "0"))
+    length = remaining
+    taken = min(remaining, len(parser.buffer))
+    del parser.buffer[:taken]
+    remaining -= taken
+    while remaining:
+        data = conn.recv(min(remaining, 1024 * 1024))
+        if not data:
+            raise ConnectionError("response body cut short")
+        remaining -= len(data)
+    return length, head.headers.get("connection", "").lower() != "close"
+
+
+def client(
+    port: int,
+    choices: list[tuple[list[str], int]],
+    keep_alive: bool,
+    deadline: float,
+    results: Results,
+) -> None:
+    """
+    Issues requests back to back until the deadline, reconnecting
+    whenever the connection is not (or no longer) persistent.
+    """
+    rng = random.Random()
+    groups = [paths for paths, _ in choices]
+    weights = [weight for _, weight in choices]
+    conn: socket.socket | None = None
+    parser = ResponseParser()
+    while time.monotonic() < deadline:
+        path = rng.choice(rng.choices(groups, weights)[0])
+        start = time.perf_counter()
+        try:
+            if conn is None:
+                conn = socket.create_connection(("127.0.0.1", port), timeout=30)
+                parser = ResponseParser()
+            length, reusable = fetch(conn, parser, path, keep_alive)
+            results.record(time.perf_counter() - start, length)
+        except OSError:
+            results.fail()
+            if conn is not None:
+                conn.close()
+            conn = None
+            continue
+        if not reusable:
+            conn.close()
+            conn = None
+    if conn is not None:
+        conn.close()
+
+
+def run_clients(
+    port: int,
+    choices: list[tuple[list[str], int]],
+    keep_alive: bool,
+    concurrency: int,
+    duration: float,
+) -> Results:
+    """
+    Runs concurrency client threads for duration seconds.
+    """
+    results = Results()
+    deadline = time.monotonic() + duration
+    threads = [
+        threading.Thread(
+            target=client, args=(port, choices, keep_alive, deadline, results)
+        )
+        for _ in range(concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def percentile(ordered: list[float], fraction: float) -> float:
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def wait_for_server(port: int, server: "subprocess.Popen[bytes]") -> None:
+    for _ in range(100):
+        if server.poll() is not None:
+            sys.exit(f"Server exited early with status {server.returncode}")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    sys.exit("Server did not start listening")
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=SRC_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark web_server.py.")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds")
+    parser.add_argument("--warmup", type=float, default=1.0, help="seconds")
+    parser.add_argument("--no-keepalive", action="store_true")
+    parser.add_argument("--mix", default="html:90,1M:9,8M:1")
+    parser.add_argument("--blockers", type=int, default=0)
+    parser.add_argument("--port", type=int, default=6790)
+    parser.add_argument("--output", help="also write the JSON results here")
+    parser.add_argument("server_args", nargs=argparse.REMAINDER)
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    port: int = args.port
+    keep_alive = not args.no_keepalive
+    server_args: list[str] = [arg for arg in args.server_args if arg != "--"]
+
+    with tempfile.TemporaryDirectory(prefix="web_server_bench_") as root:
+        choices = prepare_files(root, args.mix)
+        server = subprocess.Popen(
+            [sys.executable, os.path.join(SRC_DIR, "web_server.py")]
+            + ["--port", str(port)]
+            + server_args,
+            cwd=root,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        blockers: list[socket.socket] = []
+        try:
+            wait_for_server(port, server)
+            rss_start = process_rss_kb(server.pid)
+
+            # Slow clients that connect and never send a request
+            for _ in range(args.blockers):
+                blockers.append(socket.create_connection(("127.0.0.1", port)))
+
+            # Warm the server's caches, then measure
+            run_clients(port, choices, keep_alive, args.concurrency, args.warmup)
+            rss_peak = [process_rss_kb(server.pid)]
+            sampling = threading.Event()
+
+            def sample_rss() -> None:
+                while not sampling.wait(0.1):
+                    rss_peak.append(process_rss_kb(server.pid))
+
+            sampler = threading.Thread(target=sample_rss, daemon=True)
+            sampler.start()
+            started = time.perf_counter()
+            results = run_clients(
+                port, choices, keep_alive, args.concurrency, args.duration
+            )
+            elapsed = time.perf_counter() - started
+            sampling.set()
+            sampler.join()
+            rss_end = process_rss_kb(server.pid)
+        finally:
+            for blocker in blockers:
+                blocker.close()
+            server.terminate()
+            server.wait()
+
+    ordered = sorted(results.latencies)
+    report = {
+        "commit": git_commit(),
+        "server_args": server_args,
+        "concurrency": args.concurrency,
+        "keep_alive": keep_alive,
+        "mix": args.mix,
+        "blockers": args.blockers,
+        "duration_s": round(elapsed, 3),
+        "requests": len(ordered),
+        "errors": results.errors,
+        "requests_per_s": round(len(ordered) / elapsed, 1),
+        "megabytes_per_s": round(results.bytes_received / elapsed / 1e6, 2),
+        "latency_ms": {
+            "mean": round(statistics.fmean(ordered) * 1000, 3) if ordered else 0.0,
+            "p50": round(percentile(ordered, 0.50) * 1000, 3),
+            "p95": round(percentile(ordered, 0.95) * 1000, 3),
+            "p99": round(percentile(ordered, 0.99) * 1000, 3),
+            "max": round(ordered[-1] * 1000, 3) if ordered else 0.0,
+        },
+        "server_rss_kb": {"start": rss_start, "peak": max(rss_peak), "end": rss_end},
+    }
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+
+
+# Run the benchmark if this script is executed directly
+if __name__ == "__main__":
+    main()
@@ -2,87 +2,464 @@
 # -*- coding: utf-8 -*-
 """
 Run with the following command line parameters:
-python3 client_browser.py <hostname> <port> <file>
+python3 client_browser.py <hostname> <port> <file> [--output PATH [--resume]]
+                          [--tls] [--cafile FILE] [--insecure]
+python3 client_browser.py --urls URL [URL ...] [--url-file FILE]
+                          [--concurrency N] [--output-dir DIR]
+                          [--cafile FILE] [--insecure]
 
 Examples:
 $ python3 client_browser.py info.cern.ch 80 ""  # defaults to index.html
 $ python3 client_browser.py localhost 6789 "hello_world.html"
+$ python3 client_browser.py localhost 6789 "big.iso" --output big.iso --resume
+$ python3 client_browser.py localhost 6789 "hello_world.html" --tls --cafile cert.pem
+
+The response head is read first, and the body is then streamed to stdout
+or to the --output file as it arrives, as raw bytes, so binary files come
+through intact and memory use does not grow with the size of the file.
+Bodies framed by Content-Length, by "Transfer-Encoding: chunked",
+or by the server closing the connection are all understood.
+
+With --output, the body is saved to PATH and only the response head is printed.
+With --resume as well, an existing partial PATH is continued with a Range
+request, instead of downloading the bytes it already holds again.
+While a download is incomplete, the validator of the version it came from
+(a strong ETag, or else Last-Modified) is kept in PATH.validator and sent
+as If-Range, so if the file has changed since, the server sends all of it
+again and PATH is rewritten rather than mixing two versions.
+
+Responses that carry an ETag or Last-Modified validator are kept in a local
+cache (the CLIENT_BROWSER_CACHE directory, default ~/.cache/client_browser;
+set it to "" to disable). Later requests for the same URL send
+If-None-Match / If-Modified-Since, and on "304 Not Modified"
+the cached response is printed instead of downloading it again.
+
+With --tls, the request goes over HTTPS. Certificates are verified
+against the system's CAs, plus --cafile (e.g. a server's self-signed
+certificate), or not at all with --insecure.
+
+With --urls and/or --url-file (one URL per line, "-" for stdin), many
+http:// and https:// URLs are fetched concurrently by --concurrency
+threads. Idle keep-alive connections are pooled per host and reused, and
+bodies are streamed through a preallocated buffer: into --output-dir (one
+file per URL, or "-" for stdout), or discarded when it is not given.
+New TLS connections to a host resume the session of an earlier one,
+skipping the full handshake. Each URL gets a line with its status, size,
+time to first byte, total time and connection ("reused", "resumed" TLS
+session or "new"), and the exit status is 1 if any URL failed or
+answered 400 or above. The local cache is not used in this mode.
 """
 
+import argparse
+import hashlib
+import os
+import shutil
 import sys
 import socket
+import ssl
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from typing import IO
 
+from http_client import BUFFER_SIZE, HTTPClient, ResponseStream, split_url
+from http_parser import MAX_HEAD_BYTES, ParseError, ResponseHead, ResponseParser
+from tls import client_context
 
-def main() -> None:
-    # shows the what is in use by the user and provies 3 arguments
-    # Check if correct number of arguments is provided
-    # if len(sys.argv) < 3:
-    # print("Usage: python3 client_browser.py <hostname> <port> <file>")
-    # sys.exit(1)
+CACHE_DIR = os.environ.get(
+    "CLIENT_BROWSER_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "client_browser"),
+)
 
-    # Extract command-line arguments
-    # Extract the hostname and port fromt the command-line arguments(sys.argv)
-    server_hostname = sys.argv[1]
-    server_port = int(sys.argv[2])
 
-    # Default to requesting root ("/") if no filename is provided
-    # check: Third argument (file name is provided) if not default to ("")
-    file_name = sys.argv[3] if len(sys.argv) > 3 else ""
+def cache_path(hostname: str, port: int, file_name: str) -> str | None:
+    """
+    Where the response for a URL is cached, or None if caching is disabled.
+    """
+    if not CACHE_DIR:
+        return None
+    key = hashlib.sha256(f"{hostname}:{port}{file_name}".encode()).hexdigest()
+    return os.path.join(CACHE_DIR, key)
+
 
-    # Convert hostname to IP address
-    # Attempt to resolve the hostname to an IP address. If it fails, it prints an error and exits
+def parse_cached(path: str) -> tuple[ResponseHead, int] | None:
+    """
+    Parses the head of a response stored in the cache,
+    and returns it with its length in bytes.
+    """
+    parser = ResponseParser()
+    with open(path, "rb") as f:
+        parser.feed(f.read(MAX_HEAD_BYTES))
+    size = len(parser.buffer)
     try:
-        server_ip = socket.gethostbyname(server_hostname)
-    except socket.gaierror:
-        print(f"Error: Unable to resolve hostname {server_hostname}")
-        sys.exit(1)
+        head = parser.next_response()
+    except ParseError:
+        return None
+    return None if head is None else (head, size - len(parser.buffer))
+
+
+def validator_path(output: str) -> str:
+    """
+    Where the validator of a partial --output download is kept.
+    """
+    return output + ".validator"
+
 
+def range_validator(headers: dict[str, str]) -> str | None:
+    """
+    The validator that If-Range can check a partial download against:
+    a strong ETag, or else Last-Modified (weak ETags do not qualify).
+    """
+    etag = headers.get("etag", "")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return headers.get("last-modified")
+
+
+def cache_temp_path(path: str) -> str:
+    """
+    Where a response is written before it atomically replaces the cached copy.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return f"{path}.{os.getpid()}.tmp"
+
+
+def copy_body(
+    stream: ResponseStream, destination: IO[bytes], cached_file: str | None
+) -> None:
+    """
+    Streams the body to its destination as it arrives, and also into
+    the cache when the response can be revalidated later.
+    """
+    reply = stream.response
+    cache: IO[bytes] | None = None
+    temp_path = ""
+    if (
+        cached_file is not None
+        and reply.status == 200
+        and stream.delimited
+        and ("etag" in reply.headers or "last-modified" in reply.headers)
+    ):
+        temp_path = cache_temp_path(cached_file)
+        cache = open(temp_path, "wb")
+        cache.write(reply.raw_head)
     try:
-        # Create a TCP socket and allows the client to connect to the server
-        client_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_STREAM)
-
-        # Client connects to the server using IP and port
-        client_socket.connect((server_ip, server_port))
-        # print(f"Connected to {server_hostname} ({server_ip}) on port {server_port}")
-
-        # If file_name is empty, default to "/"
-        if file_name == "":
-            file_name = "/"
-
-        # Ensure that the file name starts with a single slash
-        if not file_name.startswith("/"):
-            file_name = "/" + file_name
-
-        # Construct the HTTP GET request for Debugging
-        request_line = f"GET {file_name} HTTP/1.1\r\n"
-        headers = f"Host: {server_hostname}\r\nConnection: close\r\n\r\n"
-        http_request = request_line + headers
-
-        # Send the HTTP GET request
-        client_socket.sendall(http_request.encode())
-        # print(f"Sent request:\n{http_request}")
-
-        # client reads the server's response in chunks of 1024 bytes and appends it to response.
-        # Continues until no more data is recieved.
-        response = b""
-        while True:
-            data = client_socket.recv(1024)
-            if not data:
-                break
-            response += data
-
-        # Print the server's response
-        # print("Response from server:")
-        print(response.decode())
-
-    except (
-        Exception
-    ) as e:  # Catch any execeptions during the conncectin or data transfer
-        print("Exception occurred:", e)
+        for piece in stream.body():
+            destination.write(piece)
+            if cache is not None:
+                cache.write(piece)
+    except BaseException:
+        if cache is not None:
+            cache.close()
+            os.remove(temp_path)
+        raise
+    if cache is not None and cached_file is not None:
+        cache.close()
+        os.replace(temp_path, cached_file)
+
+
+def save_response(
+    stream: ResponseStream,
+    output: str | None,
+    resume_from: int,
+    cached_file: str | None,
+    cached_head_length: int,
+) -> None:
+    """
+    Writes the response to stdout, or its body to the output file
+    (appending to a resumed download) with only the head printed.
+    Bodies are written as received, so binary files come out intact.
+    """
+    reply = stream.response
+    revalidated = reply.status == 304 and cached_head_length > 0
+    stdout = sys.stdout.buffer
+    destination = stdout
+    if output is None:
+        if not revalidated:
+            stdout.write(reply.raw_head)
+    else:
+        # Save the body, and print only the head
+        print(reply.raw_head.decode("iso-8859-1"), flush=True)
+        if reply.status == 416 and resume_from:
+            print(f"{output} is already complete")
+            return
+        appending = reply.status == 206 and resume_from
+        if not appending:
+            # A new download: remember which version of the file it holds
+            validator = range_validator(reply.headers)
+            if validator is None:
+                if os.path.exists(validator_path(output)):
+                    os.remove(validator_path(output))
+            else:
+                with open(validator_path(output), "w") as f:
+                    f.write(validator)
+        destination = open(output, "ab" if appending else "wb")
 
+    try:
+        if revalidated and cached_file is not None:
+            # Not modified: use the copy we already have
+            with open(cached_file, "rb") as f:
+                if output is not None:
+                    f.seek(cached_head_length)
+                shutil.copyfileobj(f, destination)
+        else:
+            copy_body(stream, destination, cached_file)
+        if output is None:
+            stdout.write(b"\n")
+            stdout.flush()
+        elif os.path.exists(validator_path(output)):
+            # Complete: there is nothing left to resume
+            os.remove(validator_path(output))
     finally:
-        # Close the socket after sending the request and receiving the response
-        client_socket.close()
+        if destination is not stdout:
+            destination.close()
+
+
+@dataclass
+class FetchResult:
+    """
+    The outcome of fetching one URL; status is 0 if no response arrived.
+    """
+
+    url: str
+    status: int = 0
+    length: int = 0
+    first_byte: float = 0.0
+    total: float = 0.0
+    reused: bool = False
+    resumed: bool = False
+    error: str = ""
+
+
+def output_path(output_dir: str, host: str, port: int, target: str) -> str:
+    """
+    Where a body is saved: DIR/host_port/path, never outside DIR.
+    """
+    names = [name for name in target.split("?")[0].split("/") if name]
+    names = [name for name in names if name not in (".", "..")] or ["index.html"]
+    return os.path.join(output_dir, f"{host}_{port}", *names)
+
+
+def fetch_url(
+    client: HTTPClient,
+    url: str,
+    output_dir: str | None,
+    stdout_lock: threading.Lock,
+) -> FetchResult:
+    """
+    Fetches one URL over a pooled connection, streaming the body to its sink.
+    """
+    result = FetchResult(url)
+    started = time.perf_counter()
+    try:
+        host, port, target, tls = split_url(url)
+        sink: IO[bytes]
+        if output_dir is None:
+            sink = open(os.devnull, "wb")
+        elif output_dir == "-":
+            # Spooled, so concurrent bodies do not interleave on stdout
+            sink = tempfile.SpooledTemporaryFile(BUFFER_SIZE)
+        else:
+            path = output_path(output_dir, host, port, target)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            sink = open(path, "wb")
+        with sink:
+            response = client.request("GET", host, port, target, sink=sink, tls=tls)
+            if output_dir == "-":
+                sink.seek(0)
+                with stdout_lock:
+                    shutil.copyfileobj(sink, sys.stdout.buffer)
+                    sys.stdout.buffer.flush()
+        result.status = response.status
+        result.length = response.length
+        result.first_byte = response.first_byte
+        result.reused = response.reused
+        result.resumed = response.resumed
+    except (OSError, ValueError) as e:
+        result.error = str(e) or type(e).__name__
+    result.total = time.perf_counter() - started
+    return result
+
+
+def read_urls(urls: list[str], url_file: str | None) -> list[str]:
+    """
+    The URLs given on the command line, then those in url_file,
+    skipping blank lines and # comments.
+    """
+    if url_file is not None:
+        with sys.stdin if url_file == "-" else open(url_file) as f:
+            lines = [line.strip() for line in f]
+        urls = urls + [line for line in lines if line and not line.startswith("#")]
+    return urls
+
+
+def fetch_many(
+    urls: list[str],
+    concurrency: int,
+    output_dir: str | None,
+    ssl_context: ssl.SSLContext | None = None,
+) -> list[FetchResult]:
+    """
+    Fetches every URL with concurrency threads sharing one connection pool,
+    and prints a report line as each one completes.
+    """
+    # The report goes to stderr when the bodies themselves go to stdout
+    report = sys.stderr if output_dir == "-" else sys.stdout
+    stdout_lock = threading.Lock()
+    results = []
+    started = time.perf_counter()
+    with HTTPClient(max_idle_per_host=concurrency, ssl_context=ssl_context) as client:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = [
+                executor.submit(fetch_url, client, url, output_dir, stdout_lock)
+                for url in urls
+            ]
+            for future in as_completed(futures):
+                result = future.result()
+                results.append(result)
+                status = str(result.status) if not result.error else "ERR"
+                connection = (
+                    "reused"
+                    if result.reused
+                    else "resumed" if result.resumed else "new"
+                )
+                print(
+                    f"{status:>3} {result.length:>10} "
+                    f"{result.first_byte * 1000:9.1f}ms {result.total * 1000:9.1f}ms "
+                    f"{connection:>6} {result.url}"
+                    + (f" ({result.error})" if result.error else ""),
+                    file=report,
+                    flush=True,
+                )
+
+    elapsed = time.perf_counter() - started
+    failed = sum(1 for result in results if result.error or result.status >= 400)
+    received = sum(result.length for result in results)
+    print(
+        f"{len(results)} URLs, {failed} failed, {received} bytes "
+        f"in {elapsed:.2f}s ({len(results) / max(elapsed, 1e-9):.1f} URLs/s)",
+        file=report,
+    )
+    return results
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="A simple Web client.")
+    parser.add_argument("hostname", nargs="?")
+    parser.add_argument("port", type=int, nargs="?")
+    # Default to requesting root ("/") if no filename is provided
+    parser.add_argument("file", nargs="?", default="")
+    parser.add_argument("--output", help="save the body to this file")
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="continue a partial --output file with a Range request",
+    )
+    parser.add_argument("--tls", action="store_true", help="use HTTPS")
+    parser.add_argument("--cafile", help="also trust the certificates in this PEM file")
+    parser.add_argument(
+        "--insecure", action="store_true", help="do not verify certificates"
+    )
+    parser.add_argument(
+        "--urls", nargs="+", default=[], help="http:// or https:// URLs to fetch"
+    )
+    parser.add_argument("--url-file", help='file of URLs, one per line ("-": stdin)')
+    parser.add_argument(
+        "--concurrency", type=int, default=8, help="URLs fetched at once"
+    )
+    parser.add_argument(
+        "--output-dir", help='save each body under this directory ("-": stdout)'
+    )
+    args = parser.parse_args()
+    if not args.urls and args.url_file is None and args.port is None:
+        parser.error("give <hostname> <port> [file], or --urls / --url-file")
+    return args
+
+
+def main() -> None:
+    # Extract the hostname, port and file from the command-line arguments
+    args = parse_args()
+    # Otherwise the client makes a default context when it first needs one
+    ssl_context = None
+    if args.cafile or args.insecure:
+        try:
+            ssl_context = client_context(args.cafile, verify=not args.insecure)
+        except OSError as e:
+            print("Exception occurred:", e)
+            sys.exit(1)
+    if args.urls or args.url_file is not None:
+        urls = read_urls(args.urls, args.url_file)
+        results = fetch_many(
+            urls, max(1, args.concurrency), args.output_dir, ssl_context
+        )
+        if any(result.error or result.status >= 400 for result in results):
+            sys.exit(1)
+        return
+
+    server_hostname: str = args.hostname
+    server_port: int = args.port
+    file_name: str = args.file
+    output: str | None = args.output
+
+    # A partial download to continue from where it stopped
+    resume_from = 0
+    if output is not None and args.resume and os.path.exists(output):
+        resume_from = os.path.getsize(output)
+
+    # If file_name is empty, default to "/"
+    if file_name == "":
+        file_name = "/"
+
+    # Ensure that the file name starts with a single slash
+    if not file_name.startswith("/"):
+        file_name = "/" + file_name
+
+    # Revalidate a cached copy instead of downloading it again
+    cached_file = cache_path(server_hostname, server_port, file_name)
+    cached_head_length = 0
+    headers: dict[str, str] = {}
+    if resume_from:
+        # Ask only for the bytes the partial download is missing
+        cached_file = None
+        headers["Range"] = f"bytes={resume_from}-"
+        assert output is not None
+        # ...of the same version of the file; otherwise all of the new one
+        if os.path.exists(validator_path(output)):
+            with open(validator_path(output)) as f:
+                headers["If-Range"] = f.read().strip()
+    if cached_file is not None and os.path.exists(cached_file):
+        cached = parse_cached(cached_file)
+        if cached is not None:
+            cached_head, cached_head_length = cached
+            if "etag" in cached_head.headers:
+                headers["If-None-Match"] = cached_head.headers["etag"]
+            if "last-modified" in cached_head.headers:
+                headers["If-Modified-Since"] = cached_head.headers["last-modified"]
+    # A single fetch has no later request to keep the connection open for
+    headers["Connection"] = "close"
+
+    with HTTPClient(ssl_context=ssl_context) as client:
+        try:
+            # Read the head first; the body is then streamed to its destination
+            stream = client.open(
+                "GET", server_hostname, server_port, file_name, headers, tls=args.tls
+            )
+        except socket.gaierror:
+            print(f"Error: Unable to resolve hostname {server_hostname}")
+            sys.exit(1)
+        except (OSError, ValueError) as e:
+            # Catch any exceptions during the connection or data transfer
+            print("Exception occurred:", e)
+            return
+        with stream:
+            try:
+                save_response(
+                    stream, output, resume_from, cached_file, cached_head_length
+                )
+            except (OSError, ValueError) as e:
+                print("Exception occurred:", e)
 
 
 # Entry point to run the main function
@@ -0,0 +1,112 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Content-Encoding negotiation and compression for the Web server.
+Compressed variants are kept in a bounded, thread-safe LRU cache,
+so a hot page is compressed once per version rather than per request.
+"""
+
+import gzip
+import threading
+import zlib
+from collections import OrderedDict
+
+# Encodings the server can produce, most preferred first
+ENCODINGS = ("gzip", "deflate")
+
+# Types that are text-like; images, video and archives are already compressed
+COMPRESSIBLE_TYPES = {
+    "application/javascript",
+    "application/json",
+    "application/xhtml+xml",
+    "application/xml",
+    "image/svg+xml",
+}
+
+
+def is_compressible(content_type: str) -> bool:
+    return content_type.startswith("text/") or content_type in COMPRESSIBLE_TYPES
+
+
+def negotiate(accept_encoding: str) -> str | None:
+    """
+    Picks the encoding with the highest q-value in an Accept-Encoding
+    header, the server's preference breaking ties, or None to send the
+    body as-is.
+
+    >>> negotiate("gzip, deflate")
+    'gzip'
+    >>> negotiate("deflate;q=1, gzip;q=0.5")
+    'deflate'
+    >>> negotiate("*;q=0.8, gzip;q=0")
+    'deflate'
+    >>> negotiate("gzip;q=0.5, identity") is None
+    True
+    """
+    allowed: dict[str, float] = {}
+    for item in accept_encoding.split(","):
+        coding, _, params = item.partition(";")
+        quality = 1.0
+        name, _, value = params.partition("=")
+        if name.strip().lower() == "q":
+            try:
+                quality = float(value)
+            except ValueError:
+                quality = 0.0
+        allowed[coding.strip().lower()] = quality
+
+    qualities = {
+        encoding: allowed.get(encoding, allowed.get("*", 0.0)) for encoding in ENCODINGS
+    }
+    # max() keeps the first of equals, so ENCODINGS order breaks ties
+    best = max(ENCODINGS, key=qualities.__getitem__)
+    quality = qualities[best]
+    # Uncompressed is always acceptable, and wins if the client prefers it
+    if quality <= 0.0 or allowed.get("identity", 0.0) > quality:
+        return None
+    return best
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    if encoding == "gzip":
+        # A fixed mtime keeps the output, and so its ETag, deterministic
+        return gzip.compress(data, compresslevel=6, mtime=0)
+    return zlib.compress(data, 6)
+
+
+class CompressionCache:
+    """
+    Least-recently-used cache of compressed bodies, bounded by total bytes,
+    keyed by the ETag of the original content and the encoding.
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self._entries: "OrderedDict[tuple[str, str], bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, etag: str, encoding: str, content: bytes) -> bytes:
+        """
+        Returns content compressed with encoding, compressing it on a miss.
+        """
+        key = (etag, encoding)
+        with self._lock:
+            compressed = self._entries.get(key)
+            if compressed is not None:
+                self._entries.move_to_end(key)
+                return compressed
+
+        # Compress outside the lock; zlib releases the GIL for large inputs
+        compressed = compress(content, encoding)
+        if len(compressed) > self.max_bytes:
+            return compressed
+
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = compressed
+                self.current_bytes += len(compressed)
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.current_bytes -= len(evicted)
+        return compressed
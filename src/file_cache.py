@@ -0,0 +1,123 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+A thread-safe, in-memory cache of file contents for the Web server.
+Entries are keyed by resolved path and evicted least-recently-used first
+once the cached bytes exceed a budget.
+Every lookup re-stat()s the file, so a file changed on disk
+is read again instead of being served stale.
+Each entry also carries a strong ETag hashed from its contents,
+computed once per version of the file.
+"""
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+
+
+@dataclass
+class CacheEntry:
+    """
+    Cached contents of one file, plus the stat() fields that validate them.
+    """
+
+    content: bytes
+    etag: str
+    size: int
+    mtime_ns: int
+    ctime_ns: int
+    inode: int
+
+
+def content_etag(content: bytes) -> str:
+    """
+    A strong entity tag that depends only on the bytes of the file.
+    """
+    return '"' + hashlib.blake2b(content, digest_size=12).hexdigest() + '"'
+
+
+class FileCache:
+    """
+    Least-recently-used cache of file contents, bounded by total bytes.
+    """
+
+    def __init__(self, max_bytes: int, max_entry_bytes: int | None = None) -> None:
+        self.max_bytes = max_bytes
+        # Files larger than this are read from disk every time
+        self.max_entry_bytes = max_bytes if max_entry_bytes is None else max_entry_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def read(
+        self, path: str, st: os.stat_result | None = None, canonical: bool = False
+    ) -> bytes:
+        """
+        Returns the contents of path, from memory when still valid.
+        Raises FileNotFoundError like open() if the file is missing.
+        Pass st to reuse a stat() the caller has just done, and canonical
+        if path is already an absolute path with no symlinks.
+        """
+        return self.lookup(path, st, canonical).content
+
+    def lookup(
+        self, path: str, st: os.stat_result | None = None, canonical: bool = False
+    ) -> CacheEntry:
+        """
+        Like read(), but returns the whole entry, including its ETag.
+        """
+        key = path if canonical else os.path.realpath(path)
+        # Cheap revalidation: one stat() instead of reading the file
+        if st is None:
+            st = os.stat(key)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if (
+                entry is not None
+                and entry.size == st.st_size
+                and entry.mtime_ns == st.st_mtime_ns
+                and entry.ctime_ns == st.st_ctime_ns
+                and entry.inode == st.st_ino
+            ):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        # Read outside the lock so a slow disk does not stall other threads
+        with open(key, "rb") as f:
+            content = f.read()
+        entry = CacheEntry(
+            content,
+            content_etag(content),
+            st.st_size,
+            st.st_mtime_ns,
+            st.st_ctime_ns,
+            st.st_ino,
+        )
+
+        # The file may have changed while it was being read; if so, do not cache it
+        if len(content) != st.st_size or len(content) > self.max_entry_bytes:
+            return entry
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.current_bytes -= old.size
+            self._entries[key] = entry
+            self.current_bytes += st.st_size
+            # Evict the least recently used entries until back under budget
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.current_bytes -= evicted.size
+        return entry
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
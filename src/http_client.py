@@ -0,0 +1,523 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+A small HTTP/1.1 client library, used by client_browser.py.
+
+Responses are read head first; the body can then be streamed to its
+destination piece by piece, through one reused buffer per thread,
+whether it is framed by Content-Length, by the chunked transfer coding,
+or by the server closing the connection. Memory use does not grow
+with the size of the body.
+
+HTTPClient keeps idle persistent connections per (host, port) and reuses
+them for later requests, so repeated fetches from one script skip the TCP
+handshake. Host names are resolved with getaddrinfo(), which returns IPv6
+as well as IPv4 addresses, and the results are cached for a TTL, so they
+skip the resolver too. Each address is tried in turn until one connects.
+
+https:// URLs (or tls=True) are fetched over TLS, verified against the
+system's CAs unless another SSL context is given. The client keeps the
+last TLS session of each host, so its next new connection there resumes
+that session with an abbreviated handshake; ClientResponse.resumed tells
+whether it did.
+
+Example:
+    with HTTPClient() as client:
+        response = client.get("http://localhost:6789/tests/web_files/hello_web.html")
+        print(response.status, len(response.body))
+
+        with client.open("GET", "localhost", 6789, "/big.iso") as stream:
+            with open("big.iso", "wb") as f:
+                for piece in stream.body():
+                    f.write(piece)
+"""
+
+import socket
+import ssl
+import threading
+import time
+from dataclasses import dataclass, field
+from collections.abc import Iterable, Iterator
+from typing import IO
+from urllib.parse import urlsplit
+
+from http_parser import ResponseParser
+from tls import client_context
+
+# Size of the receive buffer each thread reuses for every body
+BUFFER_SIZE = 256 * 1024
+MAX_CHUNK_LINE = 8 * 1024
+
+# Family, type, protocol and address, as getaddrinfo() returns them
+AddressInfo = tuple[
+    socket.AddressFamily,
+    socket.SocketKind,
+    int,
+    tuple[str, int] | tuple[str, int, int, int] | tuple[int, bytes],
+]
+
+
+class StaleConnection(ConnectionError):
+    """
+    A connection closed by the server before it sent anything back,
+    typically a pooled one that reached the server's keep-alive timeout.
+    """
+
+
+@dataclass
+class ClientResponse:
+    """
+    A received response. body is empty if it was streamed into a sink.
+    Header names are lower-cased; raw_head is the head exactly as received.
+    """
+
+    status: int
+    reason: str
+    headers: dict[str, str]
+    raw_head: bytes
+    body: bytes = b""
+    length: int = 0
+    reused: bool = False
+    resumed: bool = False
+    first_byte: float = 0.0
+
+
+@dataclass
+class PooledConnection:
+    """
+    An open connection, with the parser holding any bytes read past
+    the last response, and when it was last returned to the pool.
+    """
+
+    sock: socket.socket
+    parser: ResponseParser = field(default_factory=ResponseParser)
+    idle_since: float = 0.0
+
+
+def split_url(url: str) -> tuple[str, int, str, bool]:
+    """
+    Splits an http:// or https:// URL into host, port, request target,
+    and whether to use TLS.
+    """
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise ValueError(f"not an http:// or https:// URL: {url}")
+    tls = parts.scheme == "https"
+    target = parts.path or "/"
+    if parts.query:
+        target += "?" + parts.query
+    return parts.hostname, parts.port or (443 if tls else 80), target, tls
+
+
+class DNSCache:
+    """
+    Caches getaddrinfo() results for ttl seconds.
+    """
+
+    def __init__(self, ttl: float = 60.0) -> None:
+        self.ttl = ttl
+        self._entries: dict[tuple[str, int], tuple[float, list[AddressInfo]]] = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, host: str, port: int) -> list[AddressInfo]:
+        """
+        The addresses of host, in the resolver's order of preference.
+        Raises socket.gaierror if the name does not resolve.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get((host, port))
+            if entry is not None and entry[0] > now:
+                return entry[1]
+
+        addresses: list[AddressInfo] = [
+            (family, kind, proto, address)
+            for family, kind, proto, _, address in socket.getaddrinfo(
+                host, port, type=socket.SOCK_STREAM
+            )
+        ]
+        with self._lock:
+            self._entries[(host, port)] = (now + self.ttl, addresses)
+        return addresses
+
+    def forget(self, host: str, port: int) -> None:
+        with self._lock:
+            self._entries.pop((host, port), None)
+
+
+class HTTPClient:
+    """
+    Sends requests over pooled persistent connections. Thread-safe:
+    each request uses a connection no other request holds meanwhile.
+    """
+
+    def __init__(
+        self,
+        max_idle_per_host: int = 8,
+        dns_ttl: float = 60.0,
+        timeout: float = 30.0,
+        idle_timeout: float = 4.0,
+        ssl_context: ssl.SSLContext | None = None,
+    ) -> None:
+        self.max_idle_per_host = max_idle_per_host
+        self.timeout = timeout
+        # Drop pooled connections before the server's keep-alive timeout does
+        self.idle_timeout = idle_timeout
+        self.dns = DNSCache(dns_ttl)
+        # Made on the first TLS connection, as loading the CAs takes a while
+        self.ssl_context = ssl_context
+        self._idle: dict[tuple[str, int, bool], list[PooledConnection]] = {}
+        # The latest TLS session of each host, to resume on new connections
+        self._sessions: dict[tuple[str, int], ssl.SSLSession] = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def __enter__(self) -> "HTTPClient":
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """
+        Closes every idle connection.
+        """
+        with self._lock:
+            for idle in self._idle.values():
+                for conn in idle:
+                    conn.sock.close()
+            self._idle.clear()
+
+    def connect(self, host: str, port: int, tls: bool = False) -> socket.socket:
+        """
+        Opens a new connection, trying each address of host in turn,
+        and with tls, completes a TLS handshake on it.
+        """
+        error: OSError = OSError(f"no addresses for {host}")
+        for family, kind, proto, address in self.dns.resolve(host, port):
+            sock = socket.socket(family, kind, proto)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(address)
+            except OSError as e:
+                sock.close()
+                error = e
+                continue
+            return self._secure(sock, host, port) if tls else sock
+        # The addresses may be stale; resolve again next time
+        self.dns.forget(host, port)
+        raise error
+
+    def _secure(self, sock: socket.socket, host: str, port: int) -> ssl.SSLSocket:
+        with self._lock:
+            if self.ssl_context is None:
+                self.ssl_context = client_context()
+            context = self.ssl_context
+            session = self._sessions.get((host, port))
+        try:
+            return context.wrap_socket(sock, server_hostname=host, session=session)
+        except BaseException:
+            sock.close()
+            raise
+
+    def _keep_session(self, host: str, port: int, sock: socket.socket) -> None:
+        """
+        Remembers the TLS session of a connection that completed a response;
+        by then, the tickets a TLS 1.3 server sends after the handshake are in.
+        """
+        if isinstance(sock, ssl.SSLSocket) and sock.session is not None:
+            with self._lock:
+                self._sessions[(host, port)] = sock.session
+
+    def _checkout(
+        self, host: str, port: int, tls: bool
+    ) -> tuple[PooledConnection, bool]:
+        now = time.monotonic()
+        with self._lock:
+            idle = self._idle.get((host, port, tls), [])
+            while idle:
+                conn = idle.pop()
+                if now - conn.idle_since < self.idle_timeout:
+                    return conn, True
+                conn.sock.close()
+        return PooledConnection(self.connect(host, port, tls)), False
+
+    def _checkin(self, host: str, port: int, tls: bool, conn: PooledConnection) -> None:
+        conn.idle_since = time.monotonic()
+        with self._lock:
+            idle = self._idle.setdefault((host, port, tls), [])
+            if len(idle) < self.max_idle_per_host:
+                idle.append(conn)
+                return
+        conn.sock.close()
+
+    def get(
+        self,
+        url: str,
+        headers: dict[str, str] | None = None,
+        sink: IO[bytes] | None = None,
+    ) -> ClientResponse:
+        host, port, target, tls = split_url(url)
+        return self.request("GET", host, port, target, headers, sink, tls)
+
+    def request(
+        self,
+        method: str,
+        host: str,
+        port: int,
+        target: str,
+        headers: dict[str, str] | None = None,
+        sink: IO[bytes] | None = None,
+        tls: bool = False,
+    ) -> ClientResponse:
+        """
+        Sends one request and reads the whole response. The body is written
+        to sink if given, and otherwise returned in the response.
+        """
+        body = bytearray()
+        with self.open(method, host, port, target, headers, tls=tls) as stream:
+            for piece in stream.body():
+                if sink is not None:
+                    sink.write(piece)
+                else:
+                    body.extend(piece)
+        stream.response.body = bytes(body)
+        return stream.response
+
+    def open(
+        self,
+        method: str,
+        host: str,
+        port: int,
+        target: str,
+        headers: dict[str, str] | None = None,
+        body: Iterable[bytes] | None = None,
+        tls: bool = False,
+    ) -> "ResponseStream":
+        """
+        Sends one request and reads the response head. The body is left
+        for the caller to read from the returned stream.
+        A request body is sent piece by piece from body, already framed
+        as its headers say (Content-Length or chunked).
+        A reused connection that the server had already closed is replaced
+        by a fresh one, once, if nothing of the response had arrived and
+        the request had no body (which cannot be sent again).
+        With tls, the request goes over a TLS connection.
+        """
+        default_port = 443 if tls else 80
+        # An IPv6 literal is bracketed, as in a URL (RFC 9110 section 7.2)
+        name = f"[{host}]" if ":" in host else host
+        all_headers = {"Host": name if port == default_port else f"{name}:{port}"}
+        all_headers.update(headers or {})
+        lines = [f"{method} {target} HTTP/1.1"]
+        lines += [f"{name}: {value}" for name, value in all_headers.items()]
+        message = ("\r\n".join(lines) + "\r\n\r\n").encode()
+        started = time.perf_counter()
+
+        conn, reused = self._checkout(host, port, tls)
+        try:
+            response = self._exchange(conn, message, body, started)
+        except StaleConnection:
+            if not reused or body is not None:
+                raise
+            # Nothing was received, so the request can safely be sent again
+            conn, reused = PooledConnection(self.connect(host, port, tls)), False
+            response = self._exchange(conn, message, None, started)
+        response.reused = reused
+        if not reused and isinstance(conn.sock, ssl.SSLSocket):
+            response.resumed = bool(conn.sock.session_reused)
+        close = all_headers.get("Connection", "").lower() == "close"
+        return ResponseStream(self, host, port, tls, conn, method, response, close)
+
+    def _exchange(
+        self,
+        conn: PooledConnection,
+        message: bytes,
+        body: Iterable[bytes] | None,
+        started: float,
+    ) -> ClientResponse:
+        """
+        Sends message and body on conn and reads the response head;
+        closes conn on failure, whatever its cause.
+        """
+        try:
+            try:
+                conn.sock.sendall(message)
+            except (BrokenPipeError, ConnectionResetError) as e:
+                raise StaleConnection(str(e)) from e
+            for piece in body or ():
+                conn.sock.sendall(piece)
+            return self._receive_head(conn, started)
+        except BaseException:
+            conn.sock.close()
+            raise
+
+    def _buffer(self) -> memoryview:
+        buffer: memoryview | None = getattr(self._local, "buffer", None)
+        if buffer is None:
+            buffer = memoryview(bytearray(BUFFER_SIZE))
+            self._local.buffer = buffer
+        return buffer
+
+    def _receive_head(self, conn: PooledConnection, started: float) -> ClientResponse:
+        buffer = self._buffer()
+        parser = conn.parser
+        head = parser.next_response()
+        received = bytes(parser.buffer)
+        while head is None:
+            try:
+                count = conn.sock.recv_into(buffer)
+            except ConnectionResetError as e:
+                raise StaleConnection(str(e)) from e
+            if not count and not parser.buffer:
+                raise StaleConnection("connection closed before a response")
+            if not count:
+                raise ConnectionError("connection closed in a response head")
+            received = bytes(parser.buffer) + buffer[:count]
+            parser.feed(buffer[:count])
+            head = parser.next_response()
+        raw_head = received[: len(received) - len(parser.buffer)]
+        response = ClientResponse(head.status, head.reason, head.headers, raw_head)
+        response.first_byte = time.perf_counter() - started
+        if head.version == "HTTP/1.0" and "connection" not in head.headers:
+            # HTTP/1.0 servers close after the response unless they say otherwise
+            response.headers["connection"] = "close"
+        return response
+
+
+class ResponseStream:
+    """
+    A response whose head has arrived. body() yields the body as it is
+    received, decoded from the chunked transfer coding if need be, and
+    the connection goes back to the pool once the body has been read.
+    Closing the stream before that closes the connection.
+    """
+
+    def __init__(
+        self,
+        client: HTTPClient,
+        host: str,
+        port: int,
+        tls: bool,
+        conn: PooledConnection,
+        method: str,
+        response: ClientResponse,
+        close: bool,
+    ) -> None:
+        self.client = client
+        self.host = host
+        self.port = port
+        self.tls = tls
+        self.conn = conn
+        self.response = response
+        headers = response.headers
+        self.chunked = "chunked" in headers.get("transfer-encoding", "").lower()
+        # The body length, or None to read until the server closes
+        self.remaining: int | None = None
+        if method == "HEAD" or response.status in (204, 304) or response.status < 200:
+            self.remaining = 0
+            self.chunked = False
+        elif not self.chunked and "content-length" in headers:
+            self.remaining = int(headers["content-length"])
+        # Whether the end of the body is marked, rather than told by a close
+        self.delimited = self.chunked or self.remaining is not None
+        self.reusable = (
+            self.delimited
+            and not close
+            and headers.get("connection", "").lower() != "close"
+        )
+        self.done = False
+        # A private receive buffer, for a body read from several threads in turn
+        self.buffer: memoryview | None = None
+
+    def __enter__(self) -> "ResponseStream":
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if not self.done:
+            self.done = True
+            self.conn.sock.close()
+
+    def body(self) -> Iterator[bytes | memoryview]:
+        """
+        Yields the body in pieces. A memoryview piece is a window on a
+        reused buffer, valid only until the next piece is requested.
+        """
+        pieces = self._chunks() if self.chunked else self._read(self.remaining)
+        for piece in pieces:
+            self.response.length += len(piece)
+            yield piece
+        self.done = True
+        self.client._keep_session(self.host, self.port, self.conn.sock)
+        if self.reusable:
+            self.client._checkin(self.host, self.port, self.tls, self.conn)
+        else:
+            self.conn.sock.close()
+
+    def _read(self, remaining: int | None) -> Iterator[bytes | memoryview]:
+        """
+        Yields remaining bytes, or everything until the server closes.
+        """
+        parser = self.conn.parser
+        buffer = self.buffer or self.client._buffer()
+
+        # Body bytes that arrived together with the head
+        early = bytes(
+            parser.buffer[:remaining] if remaining is not None else parser.buffer
+        )
+        del parser.buffer[: len(early)]
+        if remaining is not None:
+            remaining -= len(early)
+        if early:
+            yield early
+
+        while remaining is None or remaining > 0:
+            size = len(buffer) if remaining is None else min(remaining, len(buffer))
+            count = self.conn.sock.recv_into(buffer[:size])
+            if not count:
+                if remaining is None:
+                    return
+                raise ConnectionError("response body cut short")
+            if remaining is not None:
+                remaining -= count
+            yield buffer[:count]
+
+    def _read_line(self) -> bytes:
+        parser = self.conn.parser
+        while True:
+            end = parser.buffer.find(b"\r\n")
+            if end >= 0:
+                line = bytes(parser.buffer[:end])
+                del parser.buffer[: end + 2]
+                return line
+            if len(parser.buffer) > MAX_CHUNK_LINE:
+                raise ValueError("chunk size line too long")
+            buffer = self.buffer or self.client._buffer()
+            count = self.conn.sock.recv_into(buffer)
+            if not count:
+                raise ConnectionError("response body cut short")
+            parser.feed(buffer[:count])
+
+    def _chunks(self) -> Iterator[bytes | memoryview]:
+        """
+        Decodes the chunked transfer coding: hexadecimal chunk sizes
+        (extensions ignored), each followed by that many bytes and CRLF,
+        up to a zero-size chunk and optional trailer fields.
+        """
+        while True:
+            line = self._read_line()
+            try:
+                size = int(line.split(b";")[0].strip(), 16)
+            except ValueError:
+                raise ValueError(f"malformed chunk size line {line!r}") from None
+            if size == 0:
+                break
+            yield from self._read(size)
+            if self._read_line():
+                raise ValueError("chunk data not followed by CRLF")
+        # Trailer fields, up to an empty line, are read and dropped
+        while self._read_line():
+            pass
@@ -0,0 +1,164 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Incremental parsing of HTTP/1.x message heads,
+shared by the Web server (requests) and the client browser (responses).
+
+Bytes are fed in as they arrive from the socket.
+The search for the blank line that ends a head resumes where the
+previous search stopped, so a head split over many TCP segments
+is scanned only once. Bytes after a head (a body, or pipelined
+requests) stay in the buffer for the caller.
+"""
+
+from dataclasses import dataclass, field
+
+MAX_HEAD_BYTES = 64 * 1024
+MAX_HEADERS = 100
+HEAD_END = b"\r\n\r\n"
+
+
+class ParseError(ValueError):
+    """
+    A malformed or oversized message, or a request the server refuses.
+    status is the response a server should answer with.
+    """
+
+    def __init__(self, message: str, status: str = "400 Bad Request") -> None:
+        super().__init__(message)
+        self.status = status
+
+
+@dataclass(slots=True)
+class Request:
+    """
+    A parsed request head. Header names are lower-cased.
+    """
+
+    method: str
+    path: str
+    version: str
+    headers: dict[str, str] = field(default_factory=dict)
+
+    @property
+    def keep_alive(self) -> bool:
+        """
+        HTTP/1.1 connections persist unless the client sends "Connection: close";
+        HTTP/1.0 connections persist only if it sends "Connection: keep-alive".
+        """
+        connection = self.headers.get("connection", "").lower()
+        if self.version == "HTTP/1.0":
+            return connection == "keep-alive"
+        return connection != "close"
+
+    def __str__(self) -> str:
+        lines = [f"{self.method} {self.path} {self.version}"]
+        lines += [f"{name}: {value}" for name, value in self.headers.items()]
+        return "\n".join(lines)
+
+
+@dataclass(slots=True)
+class ResponseHead:
+    """
+    A parsed response status line and headers. Header names are lower-cased.
+    """
+
+    version: str
+    status: int
+    reason: str
+    headers: dict[str, str] = field(default_factory=dict)
+
+
+class HeadParser:
+    """
+    Buffers incoming bytes and splits complete message heads off the front.
+    """
+
+    def __init__(
+        self, max_head_bytes: int = MAX_HEAD_BYTES, max_headers: int = MAX_HEADERS
+    ) -> None:
+        self.max_head_bytes = max_head_bytes
+        self.max_headers = max_headers
+        self.buffer = bytearray()
+        # Offset up to which the buffer is known not to contain HEAD_END
+        self._scanned = 0
+
+    def feed(self, data: bytes | memoryview) -> None:
+        self.buffer += data
+
+    def _next_head(self) -> tuple[str, dict[str, str]] | None:
+        """
+        Removes one complete head from the buffer and returns its start line
+        and headers, or returns None if the head is still incomplete.
+        """
+        # Tolerate stray empty lines before a message (RFC 9112 section 2.2)
+        while self._scanned == 0 and self.buffer[:2] == b"\r\n":
+            del self.buffer[:2]
+
+        # Resume 3 bytes back, in case the terminator straddles two reads
+        end = self.buffer.find(HEAD_END, max(0, self._scanned - 3))
+        if end < 0:
+            self._scanned = len(self.buffer)
+            if self._scanned > self.max_head_bytes:
+                raise ParseError(
+                    "message head too large", "431 Request Header Fields Too Large"
+                )
+            return None
+        if end > self.max_head_bytes:
+            raise ParseError(
+                "message head too large", "431 Request Header Fields Too Large"
+            )
+
+        head = self.buffer[:end].decode("iso-8859-1")
+        del self.buffer[: end + len(HEAD_END)]
+        self._scanned = 0
+
+        lines = head.split("\r\n")
+        if len(lines) - 1 > self.max_headers:
+            raise ParseError(
+                "too many header fields", "431 Request Header Fields Too Large"
+            )
+
+        headers: dict[str, str] = {}
+        for line in lines[1:]:
+            name, colon, value = line.partition(":")
+            if not colon or not name or name != name.strip():
+                raise ParseError(f"malformed header line {line!r}")
+            name = name.lower()
+            value = value.strip()
+            # Repeated fields are combined into one comma-separated value
+            headers[name] = f"{headers[name]}, {value}" if name in headers else value
+        return lines[0], headers
+
+
+class RequestParser(HeadParser):
+    def next_request(self) -> Request | None:
+        """
+        Returns the next complete request in the buffer, or None.
+        """
+        parsed = self._next_head()
+        if parsed is None:
+            return None
+        start_line, headers = parsed
+        parts = start_line.split(" ")
+        if len(parts) != 3 or not parts[2].startswith("HTTP/1."):
+            raise ParseError(f"malformed request line {start_line!r}")
+        method, path, version = parts
+        return Request(method, path, version, headers)
+
+
+class ResponseParser(HeadParser):
+    def next_response(self) -> ResponseHead | None:
+        """
+        Returns the next complete response head in the buffer, or None.
+        Any body bytes received with it remain in self.buffer.
+        """
+        parsed = self._next_head()
+        if parsed is None:
+            return None
+        start_line, headers = parsed
+        parts = start_line.split(" ", 2)
+        if len(parts) < 2 or not parts[0].startswith("HTTP/") or not parts[1].isdigit():
+            raise ParseError(f"malformed status line {start_line!r}")
+        reason = parts[2] if len(parts) == 3 else ""
+        return ResponseHead(parts[0], int(parts[1]), reason, headers)
@@ -0,0 +1,192 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Counters, gauges and latency histograms for the Web server,
+rendered in the Prometheus text exposition format.
+
+Recording a sample takes one short lock and, for a histogram,
+a bisect over a handful of bucket bounds, so it is cheap enough
+to do several times per request.
+Each server process keeps its own values; with pre-forked workers,
+every scrape of /metrics reports the worker that happened to accept it.
+"""
+
+import bisect
+import threading
+from collections.abc import Callable, Iterator
+
+# Upper bounds in seconds, from 100 microseconds up to 10 seconds
+LATENCY_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+def format_value(value: float) -> str:
+    return str(int(value)) if value == int(value) else repr(value)
+
+
+class Counter:
+    """
+    A monotonically increasing total, optionally split by one label,
+    or read from a function at scrape time.
+    """
+
+    kind = "counter"
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        label: str = "",
+        function: Callable[[], float] | None = None,
+    ) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.function = function
+        self._values: dict[str, float] = {} if label else {"": 0.0}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, label_value: str = "") -> None:
+        with self._lock:
+            self._values[label_value] = self._values.get(label_value, 0.0) + amount
+
+    def samples(self) -> list[str]:
+        if self.function is not None:
+            return [f"{self.name} {format_value(self.function())}"]
+        with self._lock:
+            values = sorted(self._values.items())
+        if not self.label:
+            return [f"{self.name} {format_value(values[0][1])}"]
+        return [
+            f'{self.name}{{{self.label}="{label_value}"}} {format_value(value)}'
+            for label_value, value in values
+        ]
+
+
+class Gauge:
+    """
+    A value that goes up and down, or is read from a function at scrape time.
+    """
+
+    kind = "gauge"
+
+    def __init__(
+        self, name: str, help_text: str, function: Callable[[], float] | None = None
+    ) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.function = function
+        self._value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0) -> None:
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount: float = 1.0) -> None:
+        self.inc(-amount)
+
+    def samples(self) -> list[str]:
+        value = self.function() if self.function is not None else self._value
+        return [f"{self.name} {format_value(value)}"]
+
+
+class Histogram:
+    """
+    Counts observations into cumulative buckets, plus their sum and count.
+    """
+
+    kind = "histogram"
+
+    def __init__(
+        self, name: str, help_text: str, buckets: tuple[float, ...] = LATENCY_BUCKETS
+    ) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        # One slot per bound, plus one for +Inf
+        self._counts = [0] * (len(buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append(f'{self.name}_bucket{{le="{le}"}} {cumulative}')
+        lines.append(f"{self.name}_sum {format_value(total)}")
+        lines.append(f"{self.name}_count {cumulative}")
+        return lines
+
+
+class Registry:
+    """
+    The metrics of one server process, in the order they are rendered.
+    """
+
+    def __init__(self) -> None:
+        self.metrics: list[Counter | Gauge | Histogram] = []
+
+    def counter(
+        self,
+        name: str,
+        help_text: str,
+        label: str = "",
+        function: Callable[[], float] | None = None,
+    ) -> Counter:
+        metric = Counter(name, help_text, label, function)
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(
+        self, name: str, help_text: str, function: Callable[[], float] | None = None
+    ) -> Gauge:
+        metric = Gauge(name, help_text, function)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help_text: str) -> Histogram:
+        metric = Histogram(name, help_text)
+        self.metrics.append(metric)
+        return metric
+
+    def chunks(self) -> Iterator[str]:
+        """
+        Renders one metric at a time, so a scrape can be streamed.
+        """
+        for metric in self.metrics:
+            lines = [
+                f"# HELP {metric.name} {metric.help_text}",
+                f"# TYPE {metric.name} {metric.kind}",
+            ]
+            yield "\n".join(lines + metric.samples()) + "\n"
+
+    def render(self) -> str:
+        return "".join(self.chunks())
@@ -0,0 +1,139 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Shared, read-only memory mappings of large files for the Web server.
+
+A file is mapped once per version, and every response that sends it,
+in full or in ranges, gets a memoryview slice of the same mapping.
+The pages belong to the kernel's page cache, so concurrent downloads
+share one copy of the file between all threads, and between pre-forked
+worker processes too, instead of each holding its own heap copy.
+
+Mappings are reference counted. When a file changes on disk, the next
+request maps the new version, and the old mapping is closed as soon as
+the last response still sending it is done. A file found deleted or
+replaced once its last response is done is let go of the same way.
+Each mapping holds a file descriptor and keeps the file's disk space in
+use, so the store is bounded: beyond max_files mappings, the least
+recently used ones are closed (once no response is sending them).
+A file must not be truncated in place while it is being sent from a
+mapping (reading past the new end would crash the process with SIGBUS);
+replace it instead, e.g. by writing a new file and renaming it over.
+"""
+
+import mmap
+import os
+import threading
+from collections import OrderedDict
+
+
+class MappedFile:
+    """
+    One mapped version of a file, with the stat() fields that identify it.
+    """
+
+    def __init__(self, path: str, st: os.stat_result) -> None:
+        self.path = path
+        self.size = st.st_size
+        self.mtime_ns = st.st_mtime_ns
+        self.ctime_ns = st.st_ctime_ns
+        self.inode = st.st_ino
+        with open(path, "rb") as f:
+            # The mapping stays valid after the file is closed
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.size = len(self._map)
+        self.refs = 0
+        self.stale = False
+
+    def matches(self, st: os.stat_result) -> bool:
+        return (
+            self.size == st.st_size
+            and self.mtime_ns == st.st_mtime_ns
+            and self.ctime_ns == st.st_ctime_ns
+            and self.inode == st.st_ino
+        )
+
+    def view(self) -> memoryview:
+        return memoryview(self._map)
+
+    def close(self) -> None:
+        try:
+            self._map.close()
+        except BufferError:
+            # A view is still alive somewhere; the mapping closes when it is freed
+            pass
+
+
+class MappedFileStore:
+    """
+    Thread-safe registry of mapped files, keyed by canonical path,
+    holding up to max_files mappings, least-recently-used first out.
+    """
+
+    def __init__(self, max_files: int = 64) -> None:
+        self.max_files = max_files
+        self._files: "OrderedDict[str, MappedFile]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, path: str, st: os.stat_result) -> MappedFile:
+        """
+        Returns the current mapping of path, mapping the file if needed.
+        Pass st from a fresh stat(); every acquire() needs a release().
+        """
+        with self._lock:
+            mapped = self._files.get(path)
+            if mapped is not None and mapped.matches(st):
+                mapped.refs += 1
+                self._files.move_to_end(path)
+                return mapped
+
+        # Map outside the lock; a race only maps the same version twice
+        fresh = MappedFile(path, st)
+        with self._lock:
+            old = self._files.get(path)
+            if old is not None and old.matches(st):
+                old.refs += 1
+                self._files.move_to_end(path)
+                fresh.close()
+                return old
+            if old is not None:
+                # Superseded: close it once nothing is sending it any more
+                self._drop(path)
+            fresh.refs += 1
+            self._files[path] = fresh
+            while len(self._files) > self.max_files:
+                self._drop(next(iter(self._files)))
+            return fresh
+
+    def release(self, mapped: MappedFile) -> None:
+        with self._lock:
+            mapped.refs -= 1
+            if mapped.refs or mapped.stale:
+                if mapped.refs == 0:
+                    mapped.close()
+                return
+
+        # Unused now: keep it only if the file is still the one mapped
+        try:
+            current = mapped.matches(os.stat(mapped.path))
+        except OSError:
+            current = False
+        if not current:
+            with self._lock:
+                if self._files.get(mapped.path) is mapped:
+                    self._drop(mapped.path)
+
+    def forget(self, path: str) -> None:
+        """
+        Lets go of the mapping of a file deleted or replaced on disk.
+        """
+        with self._lock:
+            if path in self._files:
+                self._drop(path)
+
+    def _drop(self, path: str) -> None:
+        # Closed now if unused, else by the release() of its last response
+        mapped = self._files.pop(path)
+        mapped.stale = True
+        if mapped.refs == 0:
+            mapped.close()
@@ -0,0 +1,100 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Maps request paths to files under the Web server's document root.
+
+A path is percent-decoded and normalized before it is joined to the root,
+so ".." segments cannot climb out of it, and the result is checked again
+after symlinks are resolved, so a link cannot point out of it either.
+Results are memoized in a bounded LRU cache: found paths for a few
+seconds, and missing ones (including paths refused for escaping the root)
+for a shorter time, so repeated requests for a missing file skip the
+filesystem too, while a file created meanwhile is found soon after.
+"""
+
+import os
+import posixpath
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import quote, unquote
+
+
+class PathResolver:
+    """
+    Thread-safe, memoizing mapping from request paths to canonical file paths.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        ttl: float = 5.0,
+        negative_ttl: float = 1.0,
+        max_entries: int = 10000,
+    ) -> None:
+        self.root = os.path.realpath(root)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        # Request path -> (expiry time, canonical path or None if missing)
+        self._entries: "OrderedDict[str, tuple[float, str | None]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def resolve(self, request_path: str) -> str | None:
+        """
+        The canonical path of the file or directory named by request_path,
+        or None if there is none inside the document root.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(request_path)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(request_path)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        path = self._map(request_path)
+        ttl = self.ttl if path is not None else self.negative_ttl
+        with self._lock:
+            self._entries[request_path] = (now + ttl, path)
+            self._entries.move_to_end(request_path)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return path
+
+    def forget(self, request_path: str) -> None:
+        """
+        Drops a result found to be stale, e.g. a file deleted since.
+        """
+        with self._lock:
+            self._entries.pop(request_path, None)
+
+    def directory_url(self, directory: str) -> str | None:
+        """
+        The request path ending in "/" that maps to directory,
+        or None if the directory is outside the document root.
+        """
+        path = os.path.realpath(directory)
+        if path == self.root:
+            return "/"
+        if not path.startswith(self.root.rstrip(os.sep) + os.sep):
+            return None
+        relative = os.path.relpath(path, self.root).replace(os.sep, "/")
+        return "/" + quote(relative) + "/"
+
+    def _map(self, request_path: str) -> str | None:
+        target = unquote(request_path.split("?", 1)[0].split("#", 1)[0])
+        if not target.startswith("/") or "\0" in target:
+            return None
+        # Normalizing an absolute path drops any ".." that would climb above "/"
+        relative = posixpath.normpath(target).lstrip("/")
+        path = os.path.realpath(os.path.join(self.root, relative))
+        # Symlinks are followed, but only to places inside the root
+        if path != self.root and not path.startswith(self.root.rstrip(os.sep) + os.sep):
+            return None
+        if not os.path.exists(path):
+            return None
+        return path
@@ -0,0 +1,418 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Reverse proxying for the Web server: requests under configured path
+prefixes are forwarded to upstream HTTP servers instead of being
+answered from the disk.
+
+Upstream connections are kept alive in an HTTPClient pool, so successive
+requests to one upstream skip the TCP handshake. Request and response
+bodies are relayed a piece at a time as they arrive, never held whole.
+A prefix may have several upstreams: each request goes to the healthy one
+with the fewest requests in flight, taking turns between equals.
+A background thread probes every upstream periodically; an upstream that
+fails a probe or a proxied request is left out until a probe succeeds.
+"""
+
+import threading
+import time
+from collections.abc import Callable, Iterator
+from dataclasses import dataclass
+from urllib.parse import urlsplit
+
+from http_client import HTTPClient, ResponseStream
+from http_parser import Request
+from uploads import RequestBody
+
+# Receive buffer of each relayed response body
+RELAY_BUFFER_SIZE = 64 * 1024
+# Headers that describe one connection, not the message (RFC 9110 section 7.6.1)
+HOP_BY_HOP = frozenset(
+    (
+        "connection",
+        "keep-alive",
+        "proxy-connection",
+        "proxy-authenticate",
+        "proxy-authorization",
+        "te",
+        "trailer",
+        "transfer-encoding",
+        "upgrade",
+    )
+)
+
+
+class UpstreamError(Exception):
+    """
+    No upstream could answer a request.
+    status is the response to send the client instead.
+    """
+
+    def __init__(self, message: str, status: str = "502 Bad Gateway") -> None:
+        super().__init__(message)
+        self.status = status
+
+
+class Upstream:
+    """
+    One upstream server, from a URL like http://127.0.0.1:8001/base.
+    """
+
+    def __init__(self, url: str) -> None:
+        parts = urlsplit(url)
+        if parts.scheme != "http" or not parts.hostname:
+            raise ValueError(f"not an http:// upstream URL: {url}")
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        # Replaces the route prefix in forwarded paths, if the URL has a path
+        self.base_path = parts.path
+        self.name = f"{self.host}:{self.port}"
+        self.healthy = True
+        # Requests currently forwarded to it
+        self.active = 0
+        self._lock = threading.Lock()
+
+    def begin(self) -> None:
+        with self._lock:
+            self.active += 1
+
+    def end(self) -> None:
+        with self._lock:
+            self.active -= 1
+
+
+def under(path: str, prefix: str) -> bool:
+    """
+    Whether path (which may carry a query) falls under prefix,
+    ending at a segment boundary.
+
+    >>> [under(p, "/api") for p in ("/api", "/api/users", "/api?q=1")]
+    [True, True, True]
+    >>> [under(p, "/api") for p in ("/apixyz", "/api-internal/users")]
+    [False, False]
+    >>> under("/api/users", "/api/")
+    True
+    """
+    if not path.startswith(prefix):
+        return False
+    return len(path) == len(prefix) or prefix.endswith("/") or path[len(prefix)] in "/?"
+
+
+def join_path(base: str, rest: str) -> str:
+    """
+    Appends what follows a prefix to another prefix, with one "/" between
+    the two; an empty rest maps to base itself.
+
+    >>> [join_path("/", r) for r in ("/small.txt", "", "?q=1")]
+    ['/small.txt', '/', '/?q=1']
+    >>> [join_path("/base", r) for r in ("/x", "x", "")]
+    ['/base/x', '/base/x', '/base']
+    """
+    if not rest or rest.startswith("?"):
+        return base + rest
+    if base.endswith("/") and rest.startswith("/"):
+        return base + rest[1:]
+    if not base.endswith("/") and not rest.startswith("/"):
+        return base + "/" + rest
+    return base + rest
+
+
+class Route:
+    """
+    A path prefix and the upstreams that serve the paths under it.
+    """
+
+    def __init__(self, prefix: str, upstreams: list[Upstream]) -> None:
+        self.prefix = prefix
+        self.upstreams = upstreams
+        self.turn = 0
+
+    def matches(self, path: str) -> bool:
+        return under(path, self.prefix)
+
+    def target(self, upstream: Upstream, path: str) -> str:
+        """
+        The path to request from upstream for a path under the prefix.
+
+        >>> Route("/api", []).target(Upstream("http://host/"), "/api/small.txt")
+        '/small.txt'
+        """
+        if not upstream.base_path:
+            return path
+        return join_path(upstream.base_path, path[len(self.prefix) :])
+
+    def client_location(self, upstream: Upstream, value: str) -> str:
+        """
+        Maps a path the upstream redirects to (Location) back under the prefix.
+
+        >>> Route("/api", []).client_location(Upstream("http://host/"), "/login")
+        '/api/login'
+        """
+        if not upstream.base_path or not under(value, upstream.base_path):
+            return value
+        return join_path(self.prefix, value[len(upstream.base_path) :])
+
+
+def parse_route(spec: str) -> Route:
+    """
+    Parses PREFIX=URL[,URL...], e.g. /api/=http://127.0.0.1:8001/,http://[::1]:8002/
+    """
+    prefix, equals, urls = spec.partition("=")
+    if not equals or not prefix.startswith("/") or not urls:
+        raise ValueError(f"invalid proxy route {spec!r}, expected PREFIX=URL[,URL...]")
+    return Route(prefix, [Upstream(url) for url in urls.split(",")])
+
+
+def connection_headers(headers: dict[str, str]) -> frozenset[str]:
+    """
+    The lower-cased names of the headers that must not be forwarded.
+    """
+    listed = headers.get("connection", "").lower().split(",")
+    return HOP_BY_HOP | {name.strip() for name in listed}
+
+
+def chunk_pieces(pieces: Iterator[bytes]) -> Iterator[bytes]:
+    for piece in pieces:
+        if piece:
+            yield f"{len(piece):X}\r\n".encode() + piece + b"\r\n"
+    yield b"0\r\n\r\n"
+
+
+@dataclass
+class Relay:
+    """
+    An upstream response whose head has arrived; its body follows.
+    length is the body length, or None if the upstream did not say.
+    """
+
+    status: str
+    headers: dict[str, str]
+    length: int | None
+    stream: ResponseStream
+    upstream: Upstream
+    closed: bool = False
+
+    def chunks(self) -> Iterator[bytes]:
+        # Pieces are windows on the stream's buffer; copy them before it refills
+        for piece in self.stream.body():
+            yield bytes(piece)
+
+    def close(self) -> None:
+        """
+        Ends the relay once the response is sent, or abandoned.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            # A body-less response (e.g. to HEAD) is finished off, so its
+            # connection goes back to the pool rather than being closed
+            if not self.stream.done and self.stream.remaining == 0:
+                for _ in self.stream.body():
+                    pass
+        finally:
+            self.stream.close()
+            self.upstream.end()
+
+
+class ReverseProxy:
+    """
+    Forwards requests to the upstreams of the route their path falls under.
+    Thread-safe.
+    """
+
+    def __init__(
+        self,
+        routes: list[Route],
+        timeout: float = 30.0,
+        max_idle_per_upstream: int = 32,
+        health_path: str = "/",
+        health_interval: float = 5.0,
+        log: Callable[[str], None] = print,
+        scheme: str = "http",
+    ) -> None:
+        # Longest prefixes first, so the most specific route wins
+        self.routes = sorted(routes, key=lambda route: len(route.prefix), reverse=True)
+        self.client = HTTPClient(max_idle_per_upstream, timeout=timeout)
+        self.health_path = health_path
+        self.health_interval = health_interval
+        self.log = log
+        # The protocol clients reach this server with (X-Forwarded-Proto)
+        self.scheme = scheme
+        self._lock = threading.Lock()
+        self._checker: threading.Thread | None = None
+
+    def route(self, path: str) -> Route | None:
+        for route in self.routes:
+            if route.matches(path):
+                return route
+        return None
+
+    def healthy_upstreams(self) -> int:
+        return sum(u.healthy for route in self.routes for u in route.upstreams)
+
+    def choose(self, route: Route, tried: list[Upstream]) -> Upstream:
+        """
+        The healthy upstream with the fewest requests in flight.
+        """
+        with self._lock:
+            candidates = [u for u in route.upstreams if u.healthy and u not in tried]
+            if not candidates:
+                raise UpstreamError(
+                    f"no healthy upstream for {route.prefix}",
+                    "503 Service Unavailable",
+                )
+            # Rotate the start, so upstreams with equal loads take turns
+            route.turn += 1
+            start = route.turn % len(candidates)
+            candidates = candidates[start:] + candidates[:start]
+            upstream = min(candidates, key=lambda u: u.active)
+            upstream.begin()
+            return upstream
+
+    def forward(
+        self,
+        request: Request,
+        client_ip: str,
+        route: Route,
+        body: RequestBody,
+        pieces: Iterator[bytes],
+    ) -> Relay:
+        """
+        Sends request to an upstream of route, with its body read from pieces
+        (the decoded body as it arrives), and returns the response to relay.
+        A request without a body is tried on another upstream if the first
+        one cannot be reached. Errors on the client's side propagate as
+        they are; the upstream's turn into UpstreamError.
+        """
+        skip = connection_headers(request.headers) | {
+            "host",
+            "expect",
+            "content-length",
+        }
+        headers = {
+            name: value for name, value in request.headers.items() if name not in skip
+        }
+        forwarded_for = request.headers.get("x-forwarded-for")
+        headers["x-forwarded-for"] = (
+            f"{forwarded_for}, {client_ip}" if forwarded_for else client_ip
+        )
+        headers["x-forwarded-host"] = request.headers.get("host", "")
+        headers["x-forwarded-proto"] = self.scheme
+
+        framed: Iterator[bytes] | None = None
+        if body.chunked:
+            headers["Transfer-Encoding"] = "chunked"
+            framed = chunk_pieces(pieces)
+        elif "content-length" in request.headers:
+            headers["Content-Length"] = request.headers["content-length"]
+            framed = None if body.done else pieces
+
+        client_failed = False
+
+        def client_body(framed: Iterator[bytes]) -> Iterator[bytes]:
+            nonlocal client_failed
+            try:
+                yield from framed
+            except BaseException:
+                client_failed = True
+                raise
+
+        tried: list[Upstream] = []
+        while True:
+            upstream = self.choose(route, tried)
+            tried.append(upstream)
+            try:
+                stream = self.client.open(
+                    request.method,
+                    upstream.host,
+                    upstream.port,
+                    route.target(upstream, request.path),
+                    headers,
+                    client_body(framed) if framed is not None else None,
+                )
+                break
+            except (OSError, ValueError) as e:
+                upstream.end()
+                if client_failed:
+                    raise
+                self.mark_failed(upstream, e)
+                others = [u for u in route.upstreams if u.healthy and u not in tried]
+                if framed is None and others:
+                    continue  # no body was consumed, so try another one
+                status = (
+                    "504 Gateway Timeout"
+                    if isinstance(e, TimeoutError)
+                    else "502 Bad Gateway"
+                )
+                raise UpstreamError(f"upstream {upstream.name}: {e}", status) from e
+
+        stream.buffer = memoryview(bytearray(RELAY_BUFFER_SIZE))
+        response = stream.response
+        skip = connection_headers(response.headers) | {"content-length"}
+        relayed: dict[str, str] = {}
+        # Header names as the upstream wrote them, rather than lower-cased
+        for line in response.raw_head.decode("iso-8859-1").split("\r\n")[1:]:
+            name, colon, value = line.partition(":")
+            if colon and name.lower() not in skip:
+                value = value.strip()
+                if name.lower() == "location":
+                    value = route.client_location(upstream, value)
+                relayed[name] = (
+                    f"{relayed[name]}, {value}" if name in relayed else value
+                )
+
+        length = stream.remaining
+        if request.method == "HEAD":
+            declared = response.headers.get("content-length", "")
+            length = int(declared) if declared.isdigit() else None
+        return Relay(
+            f"{response.status} {response.reason}",
+            relayed,
+            None if stream.chunked else length,
+            stream,
+            upstream,
+        )
+
+    def mark_failed(self, upstream: Upstream, error: Exception) -> None:
+        """
+        Leaves out an upstream that failed, until a health probe succeeds.
+        Without health checks, nothing would bring it back, so it stays in.
+        """
+        if self.health_interval > 0 and upstream.healthy:
+            upstream.healthy = False
+            self.log(f"Upstream {upstream.name} failed, leaving it out: {error}")
+
+    def start_health_checks(self) -> None:
+        if self.health_interval > 0 and self.routes and self._checker is None:
+            self._checker = threading.Thread(target=self._check_health, daemon=True)
+            self._checker.start()
+
+    def _check_health(self) -> None:
+        """
+        Probes each upstream with a GET of the health path, forever.
+        Any response but a 5xx counts as healthy.
+        """
+        probe = HTTPClient(max_idle_per_host=0, timeout=min(self.health_interval, 5.0))
+        while True:
+            # Upstreams start out healthy; they may still be starting up too
+            time.sleep(self.health_interval)
+            for route in self.routes:
+                for upstream in route.upstreams:
+                    try:
+                        response = probe.request(
+                            "GET",
+                            upstream.host,
+                            upstream.port,
+                            self.health_path,
+                            {"Connection": "close"},
+                        )
+                        healthy = response.status < 500
+                        reason = f"status {response.status}"
+                    except (OSError, ValueError) as e:
+                        healthy = False
+                        reason = str(e)
+                    if healthy != upstream.healthy:
+                        state = "back" if healthy else "down"
+                        self.log(f"Upstream {upstream.name} is {state} ({reason})")
+                        upstream.healthy = healthy
@@ -0,0 +1,185 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+TLS for the Web server and the client library.
+
+Each side builds one SSLContext upfront and uses it for every connection.
+The server context issues session tickets (and keeps OpenSSL's session
+cache), so a returning client resumes its session with an abbreviated
+handshake instead of a full key exchange. Built before the server forks
+its workers, the context's ticket keys are shared by every process, so
+a ticket issued by one worker is accepted by the others. Both sides
+advertise "http/1.1" with ALPN.
+
+The server handshake runs on non-blocking sockets, all of them driven by
+one reactor thread, so a client that is slow to negotiate holds neither
+a connection thread nor a pool worker; connections are handed over only
+once their handshake is complete.
+
+A certificate for local testing can be made with:
+openssl req -x509 -newkey rsa:2048 -nodes -days 365 -subj /CN=localhost \\
+        -keyout key.pem -out cert.pem
+"""
+
+import selectors
+import socket
+import ssl
+import threading
+import time
+from collections.abc import Callable
+
+ALPN_PROTOCOLS = ["http/1.1"]
+
+Address = tuple[str, int]
+
+
+def server_context(
+    cert_file: str, key_file: str = "", tickets: int = 2
+) -> ssl.SSLContext:
+    """
+    The context of every server connection. tickets is the number of
+    TLS 1.3 session tickets sent after a full handshake (0: none).
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(cert_file, key_file or None)
+    context.set_alpn_protocols(ALPN_PROTOCOLS)
+    context.num_tickets = tickets
+    if not tickets:
+        # TLS 1.2 tickets too; resumption then relies on the session cache
+        context.options |= ssl.OP_NO_TICKET
+    return context
+
+
+def client_context(cafile: str | None = None, verify: bool = True) -> ssl.SSLContext:
+    """
+    The context of every client connection. cafile adds trusted
+    certificates (e.g. a self-signed one); verify False trusts anything.
+    """
+    context = ssl.create_default_context(cafile=cafile)
+    if not verify:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    context.set_alpn_protocols(ALPN_PROTOCOLS)
+    return context
+
+
+class PendingHandshake:
+    """
+    A connection whose handshake is under way, and when it must be done.
+    """
+
+    def __init__(
+        self, sock: ssl.SSLSocket, address: Address, accepted: float, deadline: float
+    ) -> None:
+        self.sock = sock
+        self.address = address
+        self.accepted = accepted
+        self.deadline = deadline
+
+
+class HandshakeReactor:
+    """
+    Completes server handshakes for accepted connections on one thread.
+    ready(sock, address, accepted) is called with each connection whose
+    handshake succeeded, and failed(address, error) for each one whose
+    handshake failed or took longer than timeout seconds (it is closed).
+    """
+
+    def __init__(
+        self,
+        context: ssl.SSLContext,
+        timeout: float,
+        ready: Callable[[ssl.SSLSocket, Address, float], None],
+        failed: Callable[[Address, str], None],
+    ) -> None:
+        self.context = context
+        self.timeout = timeout
+        self.ready = ready
+        self.failed = failed
+        self._selector = selectors.DefaultSelector()
+        self._pending: dict[int, PendingHandshake] = {}
+        self._incoming: list[PendingHandshake] = []
+        self._lock = threading.Lock()
+        # Writing to the waker interrupts select() when a connection arrives
+        self._wake_reader, self._waker = socket.socketpair()
+        self._wake_reader.setblocking(False)
+        self._selector.register(self._wake_reader, selectors.EVENT_READ)
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, conn: socket.socket, address: Address, accepted: float) -> None:
+        """
+        Takes over an accepted connection until its handshake is done.
+        """
+        conn.setblocking(False)
+        sock = self.context.wrap_socket(
+            conn, server_side=True, do_handshake_on_connect=False
+        )
+        entry = PendingHandshake(
+            sock, address, accepted, time.monotonic() + self.timeout
+        )
+        with self._lock:
+            self._incoming.append(entry)
+        try:
+            self._waker.send(b"\0")
+        except BlockingIOError:
+            pass  # a wake-up is already pending
+
+    def _run(self) -> None:
+        while True:
+            now = time.monotonic()
+            deadlines = [entry.deadline for entry in self._pending.values()]
+            wait = max(0.0, min(deadlines) - now) if deadlines else None
+            for key, _ in self._selector.select(wait):
+                if key.fileobj is self._wake_reader:
+                    self._take_incoming()
+                else:
+                    assert isinstance(key.fileobj, ssl.SSLSocket)
+                    self._step(self._pending[key.fileobj.fileno()])
+
+            now = time.monotonic()
+            for entry in list(self._pending.values()):
+                if entry.deadline <= now:
+                    self._finish(entry, "TLS handshake timed out")
+
+    def _take_incoming(self) -> None:
+        try:
+            while self._wake_reader.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        with self._lock:
+            incoming, self._incoming = self._incoming, []
+        for entry in incoming:
+            self._pending[entry.sock.fileno()] = entry
+            self._selector.register(entry.sock, selectors.EVENT_READ)
+            self._step(entry)
+
+    def _step(self, entry: PendingHandshake) -> None:
+        """
+        Advances a handshake as far as the data at hand allows.
+        """
+        try:
+            entry.sock.do_handshake()
+        except ssl.SSLWantReadError:
+            self._selector.modify(entry.sock, selectors.EVENT_READ)
+        except ssl.SSLWantWriteError:
+            self._selector.modify(entry.sock, selectors.EVENT_WRITE)
+        except OSError as e:
+            self._finish(entry, f"TLS handshake failed: {e}")
+        else:
+            self._finish(entry, None)
+
+    def _finish(self, entry: PendingHandshake, error: str | None) -> None:
+        del self._pending[entry.sock.fileno()]
+        self._selector.unregister(entry.sock)
+        if error is not None:
+            entry.sock.close()
+            self.failed(entry.address, error)
+            return
+        entry.sock.setblocking(True)
+        try:
+            self.ready(entry.sock, entry.address, entry.accepted)
+        except Exception as e:
+            entry.sock.close()
+            self.failed(entry.address, f"could not hand over connection: {e}")
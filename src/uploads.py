@@ -0,0 +1,391 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Request bodies, and files uploaded with PUT or POST, for the Web server.
+
+Bodies are decoded incrementally (Content-Length or chunked framing) from
+the same buffer the request heads are parsed from, so bytes after a body,
+like a pipelined request, stay there for the next head. Decoded bytes go
+straight to a temporary file in the upload directory, so only one read's
+worth of a body is ever held in memory, however large the upload.
+A multipart/form-data body is split into its file fields on the fly.
+A finished upload is renamed over its final name, so nobody ever sees
+a partial file under that name; an interrupted one is deleted. The files
+of a form are all put in place once the whole form has arrived, so a form
+cut short leaves none of them behind.
+"""
+
+import os
+import re
+import tempfile
+from collections.abc import Callable, Iterator
+
+from http_parser import ParseError, Request
+
+MAX_CHUNK_LINE = 4096
+MAX_TRAILER_BYTES = 64 * 1024
+MAX_PART_HEAD_BYTES = 16 * 1024
+PARAMETER = re.compile(r'\s*([^=;\s]+)\s*=\s*("(?:[^"\\]|\\.)*"|[^;]*?)\s*(?:;|$)')
+
+
+def header_parameters(value: str) -> tuple[str, dict[str, str]]:
+    """
+    Splits a header value like 'form-data; name="file"; filename="a.txt"'
+    into its lower-cased first token and its parameters.
+    """
+    token, _, rest = value.partition(";")
+    parameters = {}
+    for match in PARAMETER.finditer(rest):
+        name, text = match.groups()
+        if text.startswith('"'):
+            text = re.sub(r"\\(.)", r"\1", text[1:-1])
+        parameters[name.lower()] = text
+    return token.strip().lower(), parameters
+
+
+def safe_name(name: str) -> str | None:
+    """
+    The last segment of an uploaded file name, or None if it cannot be
+    stored as it is (empty, a hidden or temporary name, or a NUL byte).
+    """
+    # Some browsers send the whole client-side path, with either separator
+    name = name.replace("\\", "/").rsplit("/", 1)[-1].strip()
+    if not name or name.startswith(".") or "\0" in name:
+        return None
+    return name
+
+
+class RequestBody:
+    """
+    Incremental decoder of one request body, framed with Content-Length
+    or chunked transfer coding. Decoded data is passed to sink, if set.
+    max_bytes, if not 0, is the most decoded bytes accepted (413 beyond).
+    """
+
+    def __init__(
+        self,
+        request: Request,
+        max_bytes: int = 0,
+        sink: Callable[[bytes], None] | None = None,
+    ) -> None:
+        self.max_bytes = max_bytes
+        self.sink = sink
+        self.received = 0
+        expect = request.headers.get("expect")
+        if expect is not None and expect.lower() != "100-continue":
+            raise ParseError(
+                f"unknown expectation {expect!r}", "417 Expectation Failed"
+            )
+        # Only HTTP/1.1 clients wait for "100 Continue" before sending a body
+        self.expects_continue = expect is not None and request.version == "HTTP/1.1"
+
+        coding = request.headers.get("transfer-encoding")
+        self.chunked = coding is not None
+        # Data bytes still due in the body, or in the current chunk
+        self.remaining = 0
+        if coding is not None:
+            if coding.lower() != "chunked":
+                raise ParseError(
+                    f"unsupported transfer coding {coding!r}", "501 Not Implemented"
+                )
+            # Framed both ways, a body could be read differently by a proxy
+            if "content-length" in request.headers:
+                raise ParseError("both Content-Length and Transfer-Encoding")
+            self._state = "size"
+        else:
+            length = request.headers.get("content-length", "0")
+            if not length.isdigit():
+                raise ParseError(f"invalid Content-Length {length!r}")
+            self.remaining = int(length)
+            self._check_size(self.remaining)
+            self._state = "data" if self.remaining else "done"
+        self._trailer_bytes = 0
+
+    @property
+    def done(self) -> bool:
+        return self._state == "done"
+
+    def take(self, buffer: bytearray) -> None:
+        """
+        Decodes and removes the body bytes at the front of buffer.
+        Whatever follows the end of the body is left in place.
+        """
+        while buffer and self._state != "done":
+            if self._state == "data":
+                count = min(self.remaining, len(buffer))
+                self._deliver(bytes(buffer[:count]))
+                del buffer[:count]
+                self.remaining -= count
+                if not self.remaining:
+                    self._state = "data end" if self.chunked else "done"
+                continue
+
+            line = self._line(buffer)
+            if line is None:
+                return
+            if self._state == "size":
+                size = line.split(b";", 1)[0].strip()
+                if not size or size.strip(b"0123456789abcdefABCDEF"):
+                    raise ParseError(f"invalid chunk size {size!r}")
+                self.remaining = int(size, 16)
+                self._state = "data" if self.remaining else "trailer"
+            elif self._state == "data end":
+                if line:
+                    raise ParseError("chunk data longer than its size")
+                self._state = "size"
+            else:
+                # Trailer fields are not used; an empty line ends them
+                self._trailer_bytes += len(line) + 2
+                if self._trailer_bytes > MAX_TRAILER_BYTES:
+                    raise ParseError("request trailer too large")
+                if not line:
+                    self._state = "done"
+
+    def stream(
+        self,
+        buffer: bytearray,
+        receive: Callable[[], bytes],
+        send_continue: Callable[[], None],
+    ) -> Iterator[bytes]:
+        """
+        Yields the decoded body as it arrives: first what is in buffer,
+        then what each receive() call brings, until the body ends.
+        A client waiting for "100 Continue" is told to go on first.
+        """
+        pieces: list[bytes] = []
+        self.sink = pieces.append
+        self.take(buffer)
+        if not self.done and self.expects_continue:
+            self.expects_continue = False
+            send_continue()
+        while True:
+            for piece in pieces:
+                yield piece
+            pieces.clear()
+            if self.done:
+                return
+            data = receive()
+            if not data:
+                raise ConnectionError("request body cut short")
+            buffer.extend(data)
+            self.take(buffer)
+
+    def _line(self, buffer: bytearray) -> bytes | None:
+        end = buffer.find(b"\r\n")
+        if end < 0:
+            if len(buffer) > MAX_CHUNK_LINE:
+                raise ParseError("chunk line too long")
+            return None
+        line = bytes(buffer[:end])
+        del buffer[: end + 2]
+        return line
+
+    def _check_size(self, size: int) -> None:
+        if self.max_bytes and size > self.max_bytes:
+            raise ParseError(
+                f"request body larger than {self.max_bytes} bytes",
+                "413 Content Too Large",
+            )
+
+    def _deliver(self, data: bytes) -> None:
+        self.received += len(data)
+        self._check_size(self.received)
+        if self.sink is not None:
+            self.sink(data)
+
+
+class UploadFile:
+    """
+    One uploaded file, written to a temporary file next to its final path.
+    """
+
+    def __init__(self, directory: str, name: str) -> None:
+        self.name = name
+        self.path = os.path.join(directory, name)
+        if os.path.isdir(self.path):
+            raise ParseError(f"{name!r} is a directory", "409 Conflict")
+        fd, self._temp_path = tempfile.mkstemp(
+            prefix=".upload-", suffix=".part", dir=directory
+        )
+        self._file = os.fdopen(fd, "wb")
+        self.size = 0
+        self.created = False
+
+    def write(self, data: bytes) -> None:
+        self._file.write(data)
+        self.size += len(data)
+
+    def close(self) -> None:
+        """
+        Ends the writing of a complete file, to be put in place later.
+        """
+        self._file.close()
+
+    def commit(self) -> None:
+        """
+        Puts the complete file in place, replacing any older version.
+        """
+        self._file.close()
+        # mkstemp() makes the file private; uploads are served like other files
+        os.chmod(self._temp_path, 0o644)
+        self.created = not os.path.exists(self.path)
+        os.replace(self._temp_path, self.path)
+
+    def abort(self) -> None:
+        self._file.close()
+        try:
+            os.remove(self._temp_path)
+        except FileNotFoundError:
+            pass
+
+
+class MultipartReader:
+    """
+    Splits a multipart/form-data body into its parts as it arrives,
+    and writes each part that carries a file name to an uploaded file,
+    left for the caller to commit. Other form fields are dropped.
+    """
+
+    def __init__(self, boundary: str, directory: str) -> None:
+        self.directory = directory
+        self.files: list[UploadFile] = []
+        self._delimiter = b"\r\n--" + boundary.encode("iso-8859-1")
+        # A leading CRLF makes the first delimiter look like the others
+        self._buffer = bytearray(b"\r\n")
+        self._state = "preamble"
+        self._file: UploadFile | None = None
+
+    def write(self, data: bytes) -> None:
+        self._buffer += data
+        while self._step():
+            pass
+
+    def close(self) -> None:
+        if self._state != "epilogue":
+            raise ParseError("multipart body cut short")
+
+    def abort(self) -> None:
+        for upload in self.files:
+            upload.abort()
+        if self._file is not None:
+            self._file.abort()
+
+    def _step(self) -> bool:
+        """
+        Parses what it can from the front of the buffer;
+        returns whether to go on.
+        """
+        buffer = self._buffer
+        if self._state == "epilogue":
+            del buffer[:]
+            return False
+
+        if self._state == "head":
+            if buffer.startswith(b"\r\n"):
+                head, end = b"", 2
+            else:
+                end = buffer.find(b"\r\n\r\n")
+                if end < 0:
+                    if len(buffer) > MAX_PART_HEAD_BYTES:
+                        raise ParseError("multipart part head too large")
+                    return False
+                head, end = bytes(buffer[:end]), end + 4
+            del buffer[:end]
+            self._open_part(head.decode("utf-8", "replace"))
+            self._state = "body"
+            return True
+
+        # In the preamble or a part body, look for the next delimiter
+        index = buffer.find(self._delimiter)
+        if index < 0:
+            # Keep a tail that could be the start of a delimiter
+            self._emit(max(0, len(buffer) - len(self._delimiter) + 1))
+            return False
+        self._emit(index)
+        # The two bytes after a delimiter tell a next part from the end
+        after = len(self._delimiter)
+        if len(buffer) < after + 2:
+            return False
+        ending = bytes(buffer[after : after + 2])
+        if ending not in (b"--", b"\r\n"):
+            raise ParseError("malformed multipart delimiter")
+        del buffer[: after + 2]
+        if self._file is not None:
+            self._file.close()
+            self.files.append(self._file)
+            self._file = None
+        self._state = "epilogue" if ending == b"--" else "head"
+        return True
+
+    def _emit(self, count: int) -> None:
+        if self._file is not None:
+            self._file.write(bytes(self._buffer[:count]))
+        del self._buffer[:count]
+
+    def _open_part(self, head: str) -> None:
+        for line in head.split("\r\n"):
+            name, _, value = line.partition(":")
+            if name.strip().lower() != "content-disposition":
+                continue
+            filename = header_parameters(value)[1].get("filename")
+            # An empty file name is a file input left blank
+            if filename:
+                name = safe_name(filename) or ""
+                if not name:
+                    raise ParseError(f"invalid file name {filename!r}")
+                self._file = UploadFile(self.directory, name)
+
+
+class Upload:
+    """
+    The body of one upload request, streamed into the upload directory:
+    a multipart/form-data form, whose file fields are stored under their
+    own names, or else the raw body, stored as name.
+    Raises ParseError if the request cannot be accepted, before any of
+    the body is read.
+    """
+
+    def __init__(
+        self, request: Request, directory: str, name: str | None, max_bytes: int
+    ) -> None:
+        self.body = RequestBody(request, max_bytes)
+        self._form: MultipartReader | None = None
+        self._file: UploadFile | None = None
+        content_type, parameters = header_parameters(
+            request.headers.get("content-type", "")
+        )
+        if request.method == "POST" and content_type == "multipart/form-data":
+            boundary = parameters.get("boundary", "")
+            if not 0 < len(boundary) <= 70:
+                raise ParseError(f"invalid multipart boundary {boundary!r}")
+            self._form = MultipartReader(boundary, directory)
+            self.body.sink = self._form.write
+        elif name is None:
+            raise ParseError("no file name to store the body under")
+        else:
+            self._file = UploadFile(directory, name)
+            self.body.sink = self._file.write
+
+    def finish(self) -> list[UploadFile]:
+        """
+        Puts the uploaded files in place, once the whole body is in.
+        """
+        if self._form is not None:
+            self._form.close()
+            if not self._form.files:
+                raise ParseError("no files in the form")
+            for upload in self._form.files:
+                upload.commit()
+            return self._form.files
+        assert self._file is not None
+        self._file.commit()
+        return [self._file]
+
+    def abort(self) -> None:
+        """
+        Deletes what was written of a body that did not arrive completely.
+        """
+        if self._form is not None:
+            self._form.abort()
+        if self._file is not None:
+            self._file.abort()
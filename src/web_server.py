@@ -4,102 +4,1831 @@
 A simple Web server.
 GET requests must name a specific file,
 since it does not assume an index.html.
+Request paths are files under --doc-root (default: the current directory);
+".." segments and symlinks cannot reach outside it.
+Resolved paths are remembered for --path-cache-ttl seconds, and missing
+ones for --negative-cache-ttl seconds, so hot paths skip the filesystem.
+
+Run with the following optional command line parameters:
+python3 web_server.py [--port PORT] [--mode {thread,async,pool}] [--backlog N]
+                      [--workers N] [--queue-size N] [--overload {queue,shed,block}]
+                      [--cache-bytes N] [--cache-entry-bytes N]
+                      [--sendfile-threshold N] [--keepalive-timeout SECONDS]
+                      [--max-keepalive-requests N] [--max-header-bytes N]
+                      [--max-headers N] [--processes N] [--last-modified]
+                      [--compress-min-bytes N] [--compress-cache-bytes N]
+                      [--header-timeout SECONDS] [--body-timeout SECONDS]
+                      [--send-timeout SECONDS] [--max-connections-per-ip N]
+                      [--access-log FILE] [--log-format {common,combined,json}]
+                      [--log-level {debug,info,warning,error}]
+                      [--log-sample FRACTION] [--log-max-bytes N]
+                      [--log-backups N] [--metrics-path PATH]
+                      [--directory-listing] [--doc-root DIR]
+                      [--path-cache-ttl SECONDS] [--negative-cache-ttl SECONDS]
+                      [--mmap-threshold N] [--mmap-max-files N]
+                      [--upload-dir DIR] [--upload-path PATH]
+                      [--max-upload-bytes N]
+                      [--proxy PREFIX=URL[,URL...]] [--proxy-timeout SECONDS]
+                      [--proxy-max-idle N] [--health-check-path PATH]
+                      [--health-check-interval SECONDS]
+                      [--tls-cert FILE] [--tls-key FILE] [--tls-tickets N]
+                      [--drain-timeout SECONDS]
+
+The default "thread" mode starts one thread per connection.
+The "async" mode serves every connection as a coroutine on a single
+asyncio event loop, so idle or slow clients do not each hold a thread.
+The "pool" mode hands accepted connections to a fixed number of worker
+threads through a bounded queue. When that queue is full, the overload
+policy decides what happens to a new connection:
+"queue" waits up to --queue-timeout seconds for room, then sheds it,
+"shed" answers 503 Service Unavailable at once,
+"block" stops accepting until a worker frees a slot.
+
+File contents are cached in memory (--cache-bytes, LRU) and revalidated
+with stat() on every request, so edits on disk are served immediately.
+Files of at least --sendfile-threshold bytes are never read into memory;
+the kernel copies them straight from the file to the socket (sendfile).
+With --mmap-threshold N, files of at least N bytes are instead mapped
+into memory once per version and sent from views of that mapping, which
+every thread and pre-forked worker shares through the page cache
+(for instance where sendfile is unavailable). Up to --mmap-max-files
+files stay mapped, the least recently sent ones are let go first.
+Replace such files by renaming a new copy over them rather than
+truncating them in place.
+Files are sent with an ETag (a content hash, or size and mtime for files
+sent with sendfile), plus Last-Modified with --last-modified. Requests with
+a matching If-None-Match or If-Modified-Since get "304 Not Modified".
+Range requests (one or several byte ranges, honoring If-Range) get
+"206 Partial Content", sliced from memory or sent with sendfile,
+and "416 Range Not Satisfiable" when no range fits the file.
+
+Responses carry a Content-Type guessed from the file extension. Text-like
+types are sent gzip or deflate encoded to clients that accept it: from a
+precompressed page.html.gz sibling if there is one, or else compressed on
+the fly (files from --compress-min-bytes up to --sendfile-threshold) and
+kept in a --compress-cache-bytes LRU cache. Already compressed types such
+as PNG images are always sent as they are.
+
+Slow or idle clients cannot pin the server down: a request head must
+arrive within --header-timeout seconds of the first byte (or of the
+connection), a request body within --body-timeout, and a response that
+the client stops reading is abandoned after --send-timeout. Idle
+persistent connections close after --keepalive-timeout. One client IP may
+hold at most --max-connections-per-ip connections; more get 429.
+
+Each request is logged as one line in the Common, Combined (the default)
+or JSON format to --access-log, and diagnostics at or above --log-level
+go to stderr. Request handlers only queue records; a background thread
+formats and writes them in batches, and rotates the log file when it
+reaches --log-max-bytes. With --log-sample below 1, only that fraction of
+successful requests is logged, while errors always are.
+
+With --metrics-path (e.g. /metrics), that path serves counters and
+latency histograms in the Prometheus text format: responses by status,
+bytes sent, active and rejected connections, accept-to-first-byte,
+request parse, response build (file read) and send times, and the file
+cache hit ratio. Each pre-forked worker process keeps its own metrics.
+
+Connections are persistent (HTTP/1.1 keep-alive): every response carries
+Content-Length, and successive or pipelined requests are served on the
+same connection until the client sends "Connection: close", stays idle
+for --keepalive-timeout seconds, or reaches --max-keepalive-requests.
+Generated bodies whose length is not known upfront (the metrics page,
+and directory listings with --directory-listing) are streamed with
+"Transfer-Encoding: chunked" instead, or, to HTTP/1.0 clients, as they
+are before closing the connection. HEAD requests get the head only.
+
+With --upload-dir DIR, PUT requests under --upload-path (default
+/uploads/) store their body as the file named by the rest of the path,
+and POST requests there store each file field of a multipart/form-data
+form under its own name. Bodies (with Content-Length or chunked) are
+streamed to a temporary file in DIR as they arrive, never held in memory
+whole, and renamed over the final name once complete; clients sending
+"Expect: 100-continue" are told to go ahead only once the upload is
+accepted, and bodies over --max-upload-bytes get "413 Content Too Large".
+A form's files are put in place only once the whole form has arrived.
+Stored files are served from wherever DIR lies under --doc-root, which
+is where the Location of a "201 Created" points; a DIR outside the
+document root is not served, and such responses have no Location.
+Without --upload-dir, PUT and POST get "405 Method Not Allowed".
+
+With --proxy PREFIX=URL[,URL...] (repeatable), requests whose path starts
+with PREFIX are forwarded to those upstream HTTP servers, e.g. other
+instances of this server, instead of being served from the disk. A URL
+with a path replaces PREFIX with it. Upstream connections are kept alive
+and reused (up to --proxy-max-idle idle ones per upstream), and request
+and response bodies are relayed as they arrive. Each request goes to the
+healthy upstream with the fewest requests in flight. Every
+--health-check-interval seconds each upstream is sent a GET of
+--health-check-path; one that fails it (or a proxied request) gets no
+requests until it passes again. Unreachable upstreams get the client
+"502 Bad Gateway", slow ones "504 Gateway Timeout" after --proxy-timeout,
+and a prefix with none healthy "503 Service Unavailable".
+
+With --tls-cert FILE (and --tls-key FILE, unless the key is in the same
+file), the server speaks HTTPS instead of plain HTTP, advertising
+"http/1.1" with ALPN. One SSL context is built at startup and shared by
+every connection and pre-forked worker; it sends --tls-tickets session
+tickets after each full handshake, so a returning client resumes its
+session without a new key exchange. Handshakes are driven by a single
+non-blocking thread (in async mode, by the event loop), so a client that
+is slow to negotiate holds no connection thread or pool worker; they too
+must finish within --header-timeout.
+
+With --processes N (0 for one per CPU core), a supervisor pre-forks N
+worker processes that each listen on the port with SO_REUSEPORT, so the
+kernel balances connections across them, and it restarts any that die.
+
+SIGTERM or SIGINT (Ctrl-C) stops the server gracefully: it stops
+accepting, serves the connections already waiting in the kernel, closes
+idle keep-alive connections, and lets requests in progress finish, for
+up to --drain-timeout seconds; a second Ctrl-C stops it at once.
+SIGHUP reloads it without downtime: the same command line is started
+again as a new process, which loads the code and options afresh and
+inherits the listening socket, so no connection is refused meanwhile.
+Once the new process is serving, the old one drains and exits; if it
+fails to start, the old one carries on. With --processes, send SIGHUP
+to the supervisor; its new workers bind the port beside the old ones.
+Switching between one and several processes needs a full restart.
 """
 
+import argparse
+import asyncio
+import functools
+import html
+import mimetypes
+import multiprocessing
+import multiprocessing.connection
+import os
+import queue
+import secrets
+import select
+import signal
 import socket
+import ssl
+import stat
+import subprocess
+import sys
 import threading
+import time
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from email.utils import formatdate, parsedate_to_datetime
+from types import FrameType
+from typing import BinaryIO
+from urllib.parse import quote, unquote
+
+from access_log import FORMATS, LEVELS, AccessLog
+from compression import CompressionCache, is_compressible, negotiate
+from file_cache import FileCache
+from http_parser import ParseError, Request, RequestParser
+from metrics import Registry
+from mmap_store import MappedFile, MappedFileStore
+from path_resolver import PathResolver
+from reverse_proxy import Relay, ReverseProxy, Route, UpstreamError, parse_route
+from tls import HandshakeReactor, server_context
+from uploads import RequestBody, Upload, UploadFile, safe_name
+
+SERVER_PORT = 6789
+NOT_FOUND_PAGE = "tests/web_files/not_found.html"
+MAX_RANGES = 16
+# Most bytes handed to an asyncio transport before waiting for it to drain
+ASYNC_WRITE_BYTES = 1024 * 1024
+# Most buffers passed to one sendmsg() call (the usual IOV_MAX)
+MAX_IOVECS = 1024
+# Largest response joined into one write on a TLS connection (no sendmsg)
+TLS_JOIN_BYTES = 256 * 1024
+# Most bytes read from a client at once while receiving a request body
+BODY_READ_SIZE = 64 * 1024
+CONTINUE_RESPONSE = b"HTTP/1.1 100 Continue\r\n\r\n"
+# Environment variables a reloading server passes file descriptors in
+LISTEN_FD_ENV = "WEB_SERVER_LISTEN_FD"
+READY_FD_ENV = "WEB_SERVER_READY_FD"
+# Longest wait for a replacement process to start serving
+REPLACEMENT_TIMEOUT = 30.0
 
 
-def handler(conn_socket: socket.socket, address: tuple[str, int]) -> None:
+def closing_page(status: str) -> bytes:
     """
-    Handles the part of the client work-flow that is client-dependent,
-    and thus may be delayed by the user, blocking program flow.
+    A complete response with a tiny page, sent just before closing.
+    """
+    body = f"<html><body><h1>{status}</h1></body></html>"
+    return (
+        f"HTTP/1.1 {status}\r\nContent-Length: {len(body)}\r\n"
+        f"Connection: close\r\n\r\n{body}"
+    ).encode()
+
+
+OVERLOADED_RESPONSE = closing_page("503 Service Unavailable")
+TOO_MANY_CONNECTIONS_RESPONSE = closing_page("429 Too Many Requests")
+
+
+@dataclass
+class ServerConfig:
+    """
+    Startup options shared by every serving mode.
+    """
+
+    port: int = SERVER_PORT
+    mode: str = "thread"
+    backlog: int = 128
+    workers: int = 8
+    queue_size: int = 64
+    overload: str = "queue"
+    queue_timeout: float = 1.0
+    cache_bytes: int = 64 * 1024 * 1024
+    cache_entry_bytes: int = 1024 * 1024
+    sendfile_threshold: int = 1024 * 1024
+    keepalive_timeout: float = 5.0
+    max_keepalive_requests: int = 100
+    max_header_bytes: int = 64 * 1024
+    max_headers: int = 100
+    processes: int = 1
+    last_modified: bool = False
+    compress_min_bytes: int = 256
+    compress_cache_bytes: int = 16 * 1024 * 1024
+    header_timeout: float = 10.0
+    body_timeout: float = 30.0
+    send_timeout: float = 30.0
+    max_connections_per_ip: int = 64
+    access_log: str = "-"
+    log_format: str = "combined"
+    log_level: str = "info"
+    log_sample: float = 1.0
+    log_max_bytes: int = 0
+    log_backups: int = 5
+    metrics_path: str = ""
+    directory_listing: bool = False
+    doc_root: str = "."
+    path_cache_ttl: float = 5.0
+    negative_cache_ttl: float = 1.0
+    mmap_threshold: int = 0
+    mmap_max_files: int = 64
+    upload_dir: str = ""
+    upload_path: str = "/uploads/"
+    max_upload_bytes: int = 100 * 1024 * 1024
+    proxy: list[str] = field(default_factory=list)
+    proxy_timeout: float = 30.0
+    proxy_max_idle: int = 32
+    health_check_path: str = "/"
+    health_check_interval: float = 5.0
+    tls_cert: str = ""
+    tls_key: str = ""
+    tls_tickets: int = 2
+    drain_timeout: float = 30.0
+
+
+@dataclass
+class Response:
+    """
+    A response ready to send: the status and extra header lines, then either
+    an in-memory body or an open file streamed with sendfile.
+    parts, when set, replaces the body with a sequence of literal bytes
+    and (offset, count) slices of the body or body file.
+    chunks, when set, is a body generated while it is sent, whose length
+    is not known upfront; it is sent with chunked transfer coding.
+    mapping, when set, is the shared mapping of a file that body is a view of.
+    relay, when set, is the upstream response that chunks relays; length
+    is then its body length if known, sent as Content-Length.
+    static_head marks a head that every response for this version of a
+    file (or this status page) shares, so its encoding is cached.
+    """
+
+    status: str
+    body: bytes | memoryview = b""
+    body_file: BinaryIO | None = None
+    headers: dict[str, str] = field(default_factory=dict)
+    parts: list[bytes | tuple[int, int]] | None = None
+    chunks: Iterator[bytes] | None = None
+    mapping: MappedFile | None = None
+    relay: Relay | None = None
+    length: int | None = None
+    static_head: bool = False
+
+    def body_parts(self) -> list[bytes | tuple[int, int]]:
+        if self.parts is not None:
+            return self.parts
+        if self.body_file is not None:
+            return [(0, os.fstat(self.body_file.fileno()).st_size)]
+        if isinstance(self.body, memoryview):
+            return [(0, len(self.body))]
+        return [self.body]
+
+    def release(self) -> None:
+        """
+        Closes the body file, or gives back the mapping or upstream
+        connection, once sent.
+        """
+        if self.body_file is not None:
+            self.body_file.close()
+        if self.mapping is not None:
+            # Drop the view first, so the mapping can be closed if stale
+            self.body = b""
+            mapped_files.release(self.mapping)
+            self.mapping = None
+        if self.relay is not None:
+            self.relay.close()
+
+    def persists(self, version: str) -> bool:
+        """
+        Whether the connection can outlive this response. HTTP/1.0 clients
+        do not understand chunked coding, so a generated body is sent to
+        them as it is, and its end is marked by closing the connection.
+        """
+        return self.chunks is None or self.length is not None or version != "HTTP/1.0"
+
+    def encode_header(
+        self, length: int | None, keep_alive: bool, version: str
+    ) -> bytes:
+        """
+        Frames the body with Content-Length when its length is known, and
+        with chunked coding otherwise, so the connection can stay open.
+        """
+        # A 304 has no body, and its Content-Length would describe the 200 one
+        framing = ""
+        if self.status.startswith("304"):
+            pass
+        elif length is not None:
+            framing = f"Content-Length: {length}"
+        elif version != "HTTP/1.0":
+            framing = "Transfer-Encoding: chunked"
+        encode = head_block if self.static_head else encode_head
+        block = encode(self.status, framing, tuple(self.headers.items()))
+        if not keep_alive:
+            return block + b"Connection: close\r\n\r\n"
+        if version == "HTTP/1.0":
+            # HTTP/1.0 clients close by default unless told otherwise
+            return block + b"Connection: keep-alive\r\n\r\n"
+        return block + b"\r\n"
+
+
+def encode_head(
+    status: str, framing: str, headers: tuple[tuple[str, str], ...]
+) -> bytes:
+    """
+    The encoded status line and header lines of a response, except the
+    per-connection ones.
+    """
+    lines = [f"HTTP/1.1 {status}"]
+    if framing:
+        lines.append(framing)
+    lines += [f"{name}: {value}" for name, value in headers]
+    return ("\r\n".join(lines) + "\r\n").encode()
+
+
+@functools.lru_cache(maxsize=4096)
+def head_block(
+    status: str, framing: str, headers: tuple[tuple[str, str], ...]
+) -> bytes:
+    """
+    encode_head() for static heads: every response for one version of a
+    file has the same block, so it is only built and encoded the first time.
+    One-off heads (ranges, uploads, relayed responses) are left out, so
+    they do not push the files' blocks out of the cache.
+    """
+    return encode_head(status, framing, headers)
+
+
+def send_buffers(conn_socket: socket.socket, buffers: list[bytes | memoryview]) -> None:
+    """
+    Like sendall() for several buffers, but with one vectored sendmsg()
+    call for all of them, so a response head and a small body leave in
+    the same segment. Partial sends resume where the kernel stopped.
+    """
+    tls = isinstance(conn_socket, ssl.SSLSocket)
+    if tls or not hasattr(conn_socket, "sendmsg"):
+        # TLS has no vectored send; a small response is joined into one write
+        if tls and sum(len(buffer) for buffer in buffers) <= TLS_JOIN_BYTES:
+            buffers = [b"".join(buffers)]
+        for buffer in buffers:
+            conn_socket.sendall(buffer)
+        return
+    views = [memoryview(buffer) for buffer in buffers if len(buffer)]
+    first = 0
+    while first < len(views):
+        sent = conn_socket.sendmsg(views[first : first + MAX_IOVECS])
+        while first < len(views) and sent >= len(views[first]):
+            sent -= len(views[first])
+            first += 1
+        if sent:
+            views[first] = views[first][sent:]
+
+
+@contextmanager
+def corked(conn_socket: socket.socket) -> Iterator[None]:
+    """
+    Holds back partial segments (Linux TCP_CORK) until the block ends,
+    so a response head goes out in the same packet as the file after it.
     """
+    cork = getattr(socket, "TCP_CORK", None)
+    if cork is None:
+        yield
+        return
+    conn_socket.setsockopt(socket.IPPROTO_TCP, cork, 1)
     try:
-        # Receives the request message from the client
-        request = conn_socket.recv(1024).decode()  # decode bytes to string
-        print(f"Received request from {address}:\n{request}")
+        yield
+    finally:
+        try:
+            conn_socket.setsockopt(socket.IPPROTO_TCP, cork, 0)
+        except OSError:
+            pass  # the connection is already gone
+
+
+def parts_length(parts: list[bytes | tuple[int, int]]) -> int:
+    return sum(len(part) if isinstance(part, bytes) else part[1] for part in parts)
+
+
+class ConnectionLimiter:
+    """
+    Counts open connections per client IP, so one client cannot hold
+    every thread or socket the server has.
+    """
+
+    def __init__(self, max_per_ip: int) -> None:
+        self.max_per_ip = max_per_ip
+        self._counts: dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._released = threading.Condition(self._lock)
+
+    def acquire(self, ip: str) -> bool:
+        """
+        Registers a new connection from ip; False if it is over the limit.
+        """
+        with self._lock:
+            count = self._counts.get(ip, 0)
+            if self.max_per_ip and count >= self.max_per_ip:
+                return False
+            self._counts[ip] = count + 1
+            return True
 
-        # Extract the path of the requested object from the message
-        filepath = request.split()[1]  # Second part is the path (requested file)
+    def release(self, ip: str) -> None:
+        with self._lock:
+            count = self._counts.pop(ip, 1) - 1
+            if count:
+                self._counts[ip] = count
+            elif not self._counts:
+                self._released.notify_all()
 
-        # If the requested file is '/', return index.html by default
-        if filepath == "/":
-            filepath = "tests/web_files/index.html"
+    def wait_closed(self, timeout: float) -> int:
+        """
+        Waits up to timeout seconds for every connection to be released;
+        returns how many are still open.
+        """
+        with self._lock:
+            self._released.wait_for(lambda: not self._counts, timeout)
+            return sum(self._counts.values())
+
+
+class IdleConnections:
+    """
+    Connections waiting for their next request. A draining server closes
+    them at once, rather than letting them wait for their keep-alive timeout.
+    """
+
+    def __init__(self) -> None:
+        self._closers: dict[object, Callable[[], object]] = {}
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def add(self, key: object, close: Callable[[], object]) -> bool:
+        """
+        Registers a connection going idle; False if the server is draining.
+        close() must be safe to call from any thread.
+        """
+        with self._lock:
+            if self._closed:
+                return False
+            self._closers[key] = close
+            return True
+
+    def remove(self, key: object) -> None:
+        with self._lock:
+            self._closers.pop(key, None)
+
+    def close_all(self) -> None:
+        with self._lock:
+            self._closed = True
+            closers, self._closers = list(self._closers.values()), {}
+        for close in closers:
+            try:
+                close()
+            except OSError:
+                pass  # the connection is already gone
+
+
+class ReadTimer:
+    """
+    Decides how long the next read from a client may wait.
+    Between requests that is the idle (keep-alive) timeout. Once a request
+    has started, or on a fresh connection, the whole head must arrive before
+    one header deadline, so a client trickling bytes cannot extend it.
+    """
 
-        # Read the requested file from the disk
-        with open(filepath[1:], "rb") as f:  # open file in binary mode to get bytes
-            response_body = f.read()  # read 404 page
+    def __init__(self) -> None:
+        self.deadline: float | None = None
+        self.idle = False
 
-        # Construct the response header
-        response_header = "HTTP/1.1 200 OK\r\n\r\n"
+    def next_timeout(self, parser: RequestParser, served: int) -> float:
+        self.idle = served > 0 and not parser.buffer and self.deadline is None
+        if self.idle:
+            return server_config.keepalive_timeout
+        if self.deadline is None:
+            self.deadline = time.monotonic() + server_config.header_timeout
+        remaining = self.deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError("request head timed out")
+        return remaining
 
-        # Send the response header and body to the client
-        conn_socket.sendall(response_header.encode())  # encode header to bytes
-        conn_socket.sendall(response_body)  # response_body is already bytes
+    def request_complete(self) -> None:
+        self.deadline = None
+
+
+class ServerMetrics:
+    """
+    What the connection handlers measure, exposed on --metrics-path.
+    """
+
+    def __init__(self) -> None:
+        self.registry = Registry()
+        add = self.registry
+        self.requests = add.counter(
+            "http_requests_total", "Responses sent, by status code.", "code"
+        )
+        self.bytes_out = add.counter(
+            "http_response_bytes_total", "Response body bytes sent."
+        )
+        self.connections = add.counter("http_connections_total", "Connections served.")
+        self.rejected = add.counter(
+            "http_connections_rejected_total",
+            "Connections turned away, by status code.",
+            "code",
+        )
+        self.active = add.gauge(
+            "http_connections_active", "Connections currently being served."
+        )
+        self.first_byte = add.histogram(
+            "http_accept_to_first_byte_seconds",
+            "Time from accepting a connection to starting its first response.",
+        )
+        self.parse = add.histogram(
+            "http_request_parse_seconds",
+            "Time from the first byte of a request head to the complete head.",
+        )
+        self.build = add.histogram(
+            "http_response_build_seconds",
+            "Time to stat, read and compress the file for a response.",
+        )
+        self.send = add.histogram(
+            "http_response_send_seconds",
+            "Time to hand a whole response to the socket.",
+        )
+        self.uploads = add.counter("http_uploaded_files_total", "Files uploaded.")
+        self.upload_bytes = add.counter(
+            "http_uploaded_bytes_total", "Bytes stored in uploaded files."
+        )
+        self.proxied = add.counter(
+            "http_proxied_requests_total",
+            "Requests forwarded to an upstream, by upstream.",
+            "upstream",
+        )
+        add.gauge(
+            "proxy_upstreams_healthy",
+            "Upstreams currently taking requests.",
+            lambda: proxy.healthy_upstreams(),
+        )
+        add.counter(
+            "tls_handshakes_total",
+            "TLS handshakes completed, full or resumed.",
+            function=lambda: tls_stat("accept_good"),
+        )
+        add.counter(
+            "tls_resumed_handshakes_total",
+            "TLS handshakes that resumed a session (ticket or session cache).",
+            function=lambda: tls_stat("hits"),
+        )
+        add.counter(
+            "file_cache_hits_total",
+            "File cache lookups served from memory.",
+            function=lambda: file_cache.hits,
+        )
+        add.counter(
+            "file_cache_misses_total",
+            "File cache lookups that read the file.",
+            function=lambda: file_cache.misses,
+        )
+        add.gauge(
+            "file_cache_hit_ratio",
+            "Fraction of file cache lookups served from memory.",
+            lambda: file_cache.hits / max(1, file_cache.hits + file_cache.misses),
+        )
+        add.gauge(
+            "file_cache_bytes",
+            "Bytes of file contents held in memory.",
+            lambda: file_cache.current_bytes,
+        )
+        add.counter(
+            "path_cache_hits_total",
+            "Request paths resolved from memory, found or missing.",
+            function=lambda: path_resolver.hits,
+        )
+        add.counter(
+            "path_cache_misses_total",
+            "Request paths resolved on the filesystem.",
+            function=lambda: path_resolver.misses,
+        )
+
+
+# Shared by every connection; main() replaces them from the command line
+server_config = ServerConfig()
+file_cache = FileCache(server_config.cache_bytes, server_config.cache_entry_bytes)
+compression_cache = CompressionCache(server_config.compress_cache_bytes)
+connection_limiter = ConnectionLimiter(server_config.max_connections_per_ip)
+access_log = AccessLog()
+path_resolver = PathResolver(server_config.doc_root)
+mapped_files = MappedFileStore(server_config.mmap_max_files)
+proxy = ReverseProxy([])
+idle_connections = IdleConnections()
+# Set once the server stops taking new connections, to end persistent ones
+draining = threading.Event()
+# Built once by main(), before workers are forked, so they share its ticket keys
+tls_context: ssl.SSLContext | None = None
+metrics = ServerMetrics()
+
+
+def tls_stat(name: str) -> int:
+    return tls_context.session_stats()[name] if tls_context is not None else 0
+
+
+def validators(st: os.stat_result, etag: str | None = None) -> dict[str, str]:
+    """
+    Validator headers for a file. Without a content ETag, one is derived
+    from size and mtime, so a large file is never read just to tag it.
+    Last-Modified is only sent when enabled, because an mtime differs
+    between checkouts of the same content.
+    """
+    headers = {"ETag": etag or f'"{st.st_size:x}-{st.st_mtime_ns:x}"'}
+    if server_config.last_modified:
+        headers["Last-Modified"] = formatdate(st.st_mtime, usegmt=True)
+    return headers
+
+
+def not_modified(request: Request, headers: dict[str, str], st: os.stat_result) -> bool:
+    """
+    Evaluates If-None-Match, or failing that If-Modified-Since (RFC 9110 13.2.2).
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        if if_none_match.strip() == "*":
+            return True
+        # Weak comparison: W/"x" matches "x"
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return headers["ETag"] in tags
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False  # an invalid date is ignored
+        # HTTP dates have one-second resolution
+        return int(st.st_mtime) <= since
+    return False
+
+
+def parse_range(value: str, size: int) -> list[tuple[int, int]] | None:
+    """
+    Parses a Range header into (offset, count) pairs clipped to the size.
+    Returns None for a header to ignore (malformed, not bytes, too many
+    ranges), and an empty list if none of the ranges is satisfiable.
+    """
+    unit, _, specs = value.partition("=")
+    if unit.strip().lower() != "bytes" or specs.count(",") >= MAX_RANGES:
+        return None
+    ranges: list[tuple[int, int]] = []
+    for spec in specs.split(","):
+        first, dash, last = spec.strip().partition("-")
+        if not dash or not (first + last).isdigit():
+            return None
+        if not first:
+            # A suffix range: the last N bytes
+            if int(last) == 0 or size == 0:
+                continue
+            start, end = max(0, size - int(last)), size - 1
+        else:
+            start = int(first)
+            end = int(last) if last else size - 1
+            if last and end < start:
+                return None
+            if start >= size:
+                continue
+        ranges.append((start, min(end, size - 1) - start + 1))
+    return ranges
+
+
+def apply_range(request: Request, response: Response, size: int) -> Response:
+    """
+    Narrows a 200 response to the byte ranges the client asked for:
+    206 with one range, 206 multipart/byteranges with several,
+    or 416 if none can be satisfied. The slices are sent straight from
+    the cached body or with sendfile, never copied into a new buffer.
+    """
+    response.headers["Accept-Ranges"] = "bytes"
+    value = request.headers.get("range")
+    if value is None or request.method != "GET":
+        return response
+
+    # If-Range: only send part of the file if the client's copy is current
+    if_range = request.headers.get("if-range")
+    if if_range is not None and if_range not in (
+        response.headers.get("ETag"),
+        response.headers.get("Last-Modified"),
+    ):
+        return response
+
+    # Partial responses describe their ranges, so their heads are one-off
+    response.static_head = False
+    ranges = parse_range(value, size)
+    if ranges is None:
+        return response
+    if not ranges:
+        response.status = "416 Range Not Satisfiable"
+        response.headers["Content-Range"] = f"bytes */{size}"
+        response.parts = []
+        return response
+
+    response.status = "206 Partial Content"
+    if len(ranges) == 1:
+        offset, count = ranges[0]
+        response.headers["Content-Range"] = (
+            f"bytes {offset}-{offset + count - 1}/{size}"
+        )
+        response.parts = [ranges[0]]
+        return response
+
+    # Several ranges: each one is preceded by its own part header
+    boundary = secrets.token_hex(12)
+    response.headers["Content-Type"] = f"multipart/byteranges; boundary={boundary}"
+    response.parts = []
+    for offset, count in ranges:
+        part_header = (
+            f"\r\n--{boundary}\r\n"
+            f"Content-Range: bytes {offset}-{offset + count - 1}/{size}\r\n\r\n"
+        )
+        response.parts += [part_header.encode(), (offset, count)]
+    response.parts.append(f"\r\n--{boundary}--\r\n".encode())
+    return response
+
+
+def content_response(
+    request: Request, headers: dict[str, str], body: bytes, st: os.stat_result
+) -> Response:
+    """
+    A response with an in-memory body, after conditional and range checks.
+    """
+    # The client's cached copy is still current: send no body
+    if not_modified(request, headers, st):
+        return Response("304 Not Modified", headers=headers, static_head=True)
+    response = Response("200 OK", body, headers=headers, static_head=True)
+    return apply_range(request, response, len(body))
+
+
+def file_response(
+    request: Request, path: str, st: os.stat_result, headers: dict[str, str]
+) -> Response:
+    """
+    A response with the contents of the file at path, as they are on disk.
+    """
+    # With --mmap-threshold, large files are sent from shared mappings
+    if server_config.mmap_threshold and st.st_size >= server_config.mmap_threshold:
+        headers.update(validators(st))
+        if not_modified(request, headers, st):
+            return Response("304 Not Modified", headers=headers, static_head=True)
+        mapped = mapped_files.acquire(path, st)
+        response = Response(
+            "200 OK", mapped.view(), headers=headers, mapping=mapped, static_head=True
+        )
+        return apply_range(request, response, mapped.size)
+
+    # Large files are left on disk, to be copied to the socket by the kernel
+    if st.st_size >= server_config.sendfile_threshold:
+        headers.update(validators(st))
+        if not_modified(request, headers, st):
+            return Response("304 Not Modified", headers=headers, static_head=True)
+        body_file = open(path, "rb")
+        response = Response(
+            "200 OK", body_file=body_file, headers=headers, static_head=True
+        )
+        return apply_range(request, response, os.fstat(body_file.fileno()).st_size)
+
+    # Read the requested file from memory, or from the disk if it changed
+    entry = file_cache.lookup(path, st, canonical=True)
+    headers.update(validators(st, entry.etag))
+    return content_response(request, headers, entry.content, st)
+
+
+def listing_chunks(entries: list[os.DirEntry[str]], url_path: str) -> Iterator[bytes]:
+    """
+    Generates an HTML directory listing, a batch of entries at a time.
+    """
+    title = html.escape(url_path)
+    yield (
+        f"<!DOCTYPE html>\n<html><head><title>Index of {title}</title></head>\n"
+        f"<body><h1>Index of {title}</h1>\n<ul>\n"
+    ).encode()
+    for start in range(0, len(entries), 64):
+        lines = []
+        for entry in entries[start : start + 64]:
+            name = entry.name + ("/" if entry.is_dir() else "")
+            lines.append(f'<li><a href="{quote(name)}">{html.escape(name)}</a></li>\n')
+        yield "".join(lines).encode()
+    yield b"</ul>\n</body></html>\n"
+
+
+def directory_response(request: Request, path: str) -> Response:
+    """
+    Lists a directory if --directory-listing is on; otherwise it is not found.
+    The listing page is generated while it is sent.
+    """
+    if not server_config.directory_listing:
+        return not_found_response()
+    url_path, question, query = request.path.partition("?")
+    if not url_path.endswith("/"):
+        # Relative links in the listing need the directory URL to end in "/"
+        return Response(
+            "301 Moved Permanently",
+            headers={"Location": url_path + "/" + question + query},
+        )
+    with os.scandir(path) as scan:
+        entries = sorted(scan, key=lambda entry: entry.name)
+    return Response(
+        "200 OK",
+        headers={"Content-Type": "text/html; charset=utf-8"},
+        chunks=listing_chunks(entries, url_path),
+    )
+
+
+def build_response(request: Request) -> Response:
+    """
+    Looks up the file named by a parsed request.
+    Returns the response to send, and is shared by every serving mode.
+    """
+    # The path of the requested object
+    filepath = request.path
+
+    if server_config.metrics_path and filepath == server_config.metrics_path:
+        return Response(
+            "200 OK",
+            headers={
+                "Content-Type": "text/plain; version=0.0.4; charset=utf-8",
+                "Cache-Control": "no-store",
+            },
+            chunks=(text.encode() for text in metrics.registry.chunks()),
+        )
+
+    # Map the path into the document root; None if there is no such file
+    path = path_resolver.resolve(filepath)
+    if path is None:
+        return not_found_response()
+
+    try:
+        st = os.stat(path)
+        if stat.S_ISDIR(st.st_mode):
+            return directory_response(request, path)
+
+        # Files that are themselves compressed (like .gz) are sent as opaque bytes
+        content_type, file_encoding = mimetypes.guess_type(path)
+        if content_type is None or file_encoding is not None:
+            content_type = "application/octet-stream"
+        headers = {"Content-Type": content_type}
+
+        encoding = None
+        if is_compressible(content_type):
+            headers["Vary"] = "Accept-Encoding"
+            encoding = negotiate(request.headers.get("accept-encoding", ""))
+
+        # A precompressed sibling, like page.html.gz, is sent as it is
+        gzip_path = path_resolver.resolve(filepath + ".gz") if encoding else None
+        if encoding == "gzip" and gzip_path is not None:
+            headers["Content-Encoding"] = "gzip"
+            return file_response(request, gzip_path, os.stat(gzip_path), headers)
+
+        # Otherwise compress small enough files on the fly, once per version
+        if (
+            encoding is None
+            or st.st_size < server_config.compress_min_bytes
+            or st.st_size >= server_config.sendfile_threshold
+        ):
+            return file_response(request, path, st, headers)
+        entry = file_cache.lookup(path, st, canonical=True)
+        body = compression_cache.get(entry.etag, encoding, entry.content)
+        # Each encoding of the file is a different representation, with its own tag
+        headers.update(validators(st, f'{entry.etag[:-1]}-{encoding}"'))
+        headers["Content-Encoding"] = encoding
+        return content_response(request, headers, body, st)
 
     except FileNotFoundError:
-        # Handle file not found case (404)
+        # Deleted since it was resolved; look it up again next time
+        path_resolver.forget(filepath)
+        path_resolver.forget(filepath + ".gz")
+        mapped_files.forget(path)
+        return not_found_response()
+
+
+def not_found_response() -> Response:
+    """
+    The 404 page, usually from memory.
+    """
+    headers = {"Content-Type": "text/html"}
+    try:
+        # Return the contents of 'not_found.html'
+        response_body = file_cache.read(NOT_FOUND_PAGE)
+        return Response(
+            "404 Not Found", response_body, headers=headers, static_head=True
+        )
+
+    except FileNotFoundError:
+        # If the 'not_found.html' itself doesn't exist, send a basic 404 response
+        response_body = b"<html><body><h1>404 Not Found</h1></body></html>"
+        return Response(
+            "404 Not Found", response_body, headers=headers, static_head=True
+        )
+
+
+def frame_chunk(chunk: bytes, version: str) -> list[bytes | memoryview]:
+    """
+    One piece of a generated body: a chunk, or the bytes as they are
+    for HTTP/1.0 clients.
+    """
+    if version == "HTTP/1.0":
+        return [chunk]
+    return [f"{len(chunk):X}\r\n".encode(), chunk, b"\r\n"]
+
+
+def last_chunk(version: str) -> bytes:
+    return b"" if version == "HTTP/1.0" else b"0\r\n\r\n"
+
+
+def send_response(
+    conn_socket: socket.socket,
+    response: Response,
+    keep_alive: bool,
+    version: str,
+    send_body: bool = True,
+) -> int:
+    """
+    Sends a response on a blocking socket, and returns the body length.
+    With send_body False (a HEAD request), only the head is sent.
+    socket.sendfile() uses os.sendfile() where the platform has it,
+    and falls back to reading and sending chunks where it does not.
+    """
+    if response.chunks is not None:
+        framed = response.length is None
         try:
-            # Open 'not_found.html' in binary mode to return its content
-            with open("tests/web_files/not_found.html", "rb") as file:
-                response_body = file.read()  # content is bytes
+            header = response.encode_header(response.length, keep_alive, version)
+            conn_socket.sendall(header)
+            length = 0
+            # Each piece goes out as soon as it is generated; empty ones would end it
+            for chunk in response.chunks if send_body else ():
+                if chunk:
+                    if framed:
+                        send_buffers(conn_socket, frame_chunk(chunk, version))
+                    else:
+                        conn_socket.sendall(chunk)
+                    length += len(chunk)
+            if send_body and framed:
+                conn_socket.sendall(last_chunk(version))
+            return length
+        finally:
+            response.release()
+
+    parts = response.body_parts()
+    length = parts_length(parts)
+    try:
+        header = response.encode_header(length, keep_alive, version)
+        if not send_body:
+            conn_socket.sendall(header)
+            return 0
+        if response.body_file is None:
+            # The head and every slice of the body in one vectored write
+            view = memoryview(response.body)
+            buffers: list[bytes | memoryview] = [header]
+            for part in parts:
+                if isinstance(part, bytes):
+                    buffers.append(part)
+                else:
+                    offset, count = part
+                    buffers.append(view[offset : offset + count])
+            send_buffers(conn_socket, buffers)
+            return length
+        with corked(conn_socket):
+            conn_socket.sendall(header)
+            for part in parts:
+                if isinstance(part, bytes):
+                    conn_socket.sendall(part)  # already bytes
+                else:
+                    # Never send more than announced, even if the file grew meanwhile
+                    offset, count = part
+                    conn_socket.sendfile(response.body_file, offset, count)
+        return length
+    finally:
+        response.release()
+
+
+async def async_send_response(
+    writer: asyncio.StreamWriter,
+    response: Response,
+    keep_alive: bool,
+    version: str,
+    send_body: bool = True,
+) -> int:
+    """
+    Sends a response on an event-loop connection.
+    loop.sendfile() likewise falls back to chunked reads when needed.
+    Every wait for the client to take more data is bounded by the send timeout.
+    """
+    if response.chunks is not None:
+        framed = response.length is None
+        try:
+            writer.write(response.encode_header(response.length, keep_alive, version))
+            length = 0
+            chunks = response.chunks if send_body else iter(())
+            while True:
+                if response.relay is not None:
+                    # Waiting on the upstream must not block the event loop
+                    chunk = await asyncio.to_thread(next, chunks, None)
+                else:
+                    chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                if chunk:
+                    writer.writelines(
+                        frame_chunk(chunk, version) if framed else [chunk]
+                    )
+                    length += len(chunk)
+                    await asyncio.wait_for(writer.drain(), server_config.send_timeout)
+            if send_body and framed:
+                writer.write(last_chunk(version))
+            await asyncio.wait_for(writer.drain(), server_config.send_timeout)
+            return length
+        finally:
+            response.release()
+
+    parts = response.body_parts()
+    length = parts_length(parts)
+    try:
+        header = response.encode_header(length, keep_alive, version)
+        if not send_body:
+            writer.write(header)
+            await asyncio.wait_for(writer.drain(), server_config.send_timeout)
+            return 0
+        # Buffers are handed over together, so the head and a small body
+        # leave in one write; large (mapped) bodies go a slice at a time,
+        # so the transport never buffers a copy of the whole file
+        pending: list[bytes | memoryview] = [header]
+        pending_bytes = len(header)
+        for part in parts:
+            if isinstance(part, bytes):
+                pending.append(part)
+                pending_bytes += len(part)
+            elif response.body_file is None:
+                offset, count = part
+                view = memoryview(response.body)
+                for start in range(offset, offset + count, ASYNC_WRITE_BYTES):
+                    piece = view[start : min(start + ASYNC_WRITE_BYTES, offset + count)]
+                    pending.append(piece)
+                    pending_bytes += len(piece)
+                    if pending_bytes >= ASYNC_WRITE_BYTES:
+                        writer.writelines(pending)
+                        pending, pending_bytes = [], 0
+                        await asyncio.wait_for(
+                            writer.drain(), server_config.send_timeout
+                        )
+            else:
+                offset, count = part
+                writer.writelines(pending)
+                pending, pending_bytes = [], 0
+                await asyncio.wait_for(writer.drain(), server_config.send_timeout)
+                loop = asyncio.get_running_loop()
+                await loop.sendfile(writer.transport, response.body_file, offset, count)
+        writer.writelines(pending)
+        await asyncio.wait_for(writer.drain(), server_config.send_timeout)
+        return length
+    finally:
+        response.release()
+
+
+def status_response(status: str) -> Response:
+    """
+    A response with a tiny page that just gives its status.
+    """
+    body = f"<html><body><h1>{status}</h1></body></html>".encode()
+    if status.startswith("405"):
+        return Response(status, body, headers={"Allow": "GET, HEAD"}, static_head=True)
+    return Response(status, body, static_head=True)
+
+
+def error_response(error: ParseError) -> Response:
+    """
+    A response for a request that could not be parsed; the connection
+    is closed after it, since the rest of the stream cannot be trusted.
+    """
+    return status_response(error.status)
+
+
+def start_upload(request: Request) -> Upload | None:
+    """
+    For a PUT or POST request, checks that it may upload where it asks to,
+    and returns the upload that will receive its body. None for other methods.
+    """
+    if request.method not in ("PUT", "POST"):
+        return None
+    prefix = server_config.upload_path
+    target = request.path.split("?", 1)[0]
+    if not server_config.upload_dir or not target.startswith(prefix):
+        raise ParseError(
+            f"{request.method} not allowed on {request.path}", "405 Method Not Allowed"
+        )
+    name: str | None = unquote(target[len(prefix) :])
+    if not name:
+        name = None  # only a form names its own files
+    elif safe_name(name) != name:
+        raise ParseError(f"invalid upload name {name!r}", "404 Not Found")
+    return Upload(
+        request, server_config.upload_dir, name, server_config.max_upload_bytes
+    )
+
+
+def upload_response(files: list[UploadFile]) -> Response:
+    """
+    "201 Created" if any of the files is new, "200 OK" if all replaced
+    older versions, with one line per file stored.
+    """
+    # Where the stored files are served, if the upload directory is
+    # inside the document root
+    base_url = path_resolver.directory_url(server_config.upload_dir)
+    for upload in files:
+        metrics.uploads.inc()
+        metrics.upload_bytes.inc(upload.size)
+        if base_url is not None:
+            # Drop any "missing" verdict cached before the file existed
+            path_resolver.forget(base_url + upload.name)
+            path_resolver.forget(base_url + quote(upload.name))
+    lines = "".join(f"{upload.name} {upload.size}\n" for upload in files)
+    headers = {"Content-Type": "text/plain; charset=utf-8"}
+    if len(files) == 1 and base_url is not None:
+        headers["Location"] = base_url + quote(files[0].name)
+    created = any(upload.created for upload in files)
+    return Response(
+        "201 Created" if created else "200 OK", lines.encode(), headers=headers
+    )
+
+
+def read_body(
+    conn_socket: socket.socket, parser: RequestParser, body: RequestBody
+) -> None:
+    """
+    Receives a request body into body, starting with any part of it already
+    buffered, so that the next pipelined request is found where it starts.
+    Bodies the server has no use for are read and dropped the same way.
+    The whole body must arrive before the body deadline.
+    """
+    body.take(parser.buffer)
+    if body.done:
+        return
+    if body.expects_continue:
+        conn_socket.sendall(CONTINUE_RESPONSE)
+    deadline = time.monotonic() + server_config.body_timeout
+    while not body.done:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError("request body timed out")
+        conn_socket.settimeout(remaining)
+        data = conn_socket.recv(BODY_READ_SIZE)
+        if not data:
+            raise ConnectionError("request body cut short")
+        parser.feed(data)
+        body.take(parser.buffer)
+
+
+async def async_read_body(
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+    parser: RequestParser,
+    body: RequestBody,
+) -> None:
+    """
+    Coroutine version of read_body(). Uploaded data is written to disk
+    from the event loop; those writes go to the page cache and are short.
+    """
+    body.take(parser.buffer)
+    if body.done:
+        return
+    if body.expects_continue:
+        writer.write(CONTINUE_RESPONSE)
+    deadline = time.monotonic() + server_config.body_timeout
+    while not body.done:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError("request body timed out")
+        data = await asyncio.wait_for(reader.read(BODY_READ_SIZE), remaining)
+        if not data:
+            raise ConnectionError("request body cut short")
+        parser.feed(data)
+        body.take(parser.buffer)
+
+
+def relayed_response(relay: Relay) -> Response:
+    metrics.proxied.inc(label_value=relay.upstream.name)
+    return Response(
+        relay.status,
+        headers=relay.headers,
+        chunks=relay.chunks(),
+        relay=relay,
+        length=relay.length,
+    )
+
 
-            # Create a response header for 404 error
-            response_header = "HTTP/1.1 404 Not Found\r\n\r\n"
+def proxy_response(
+    conn_socket: socket.socket,
+    parser: RequestParser,
+    request: Request,
+    address: tuple[str, int],
+    route: Route,
+) -> Response:
+    """
+    Forwards a request to an upstream of route, relaying its body from
+    the client as it arrives, and returns the upstream's response.
+    When no upstream can take it, the rest of the body is read and dropped,
+    so the connection stays usable for an error response and beyond.
+    """
+    body = RequestBody(request)
+    deadline = time.monotonic() + server_config.body_timeout
+
+    def receive() -> bytes:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError("request body timed out")
+        conn_socket.settimeout(remaining)
+        return conn_socket.recv(BODY_READ_SIZE)
+
+    def send_continue() -> None:
+        conn_socket.sendall(CONTINUE_RESPONSE)
+
+    pieces = body.stream(parser.buffer, receive, send_continue)
+    try:
+        return relayed_response(proxy.forward(request, address[0], route, body, pieces))
+    except UpstreamError as e:
+        access_log.warning(f"Proxying {request.path} failed: {e}")
+        body.sink = None
+        read_body(conn_socket, parser, body)
+        return status_response(e.status)
+
+
+async def async_proxy_response(
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+    parser: RequestParser,
+    request: Request,
+    address: tuple[str, int],
+    route: Route,
+) -> Response:
+    """
+    Coroutine version of proxy_response(). Upstream connections are
+    blocking, so the exchange runs in a worker thread, which reads the
+    request body back through the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    body = RequestBody(request)
+    deadline = time.monotonic() + server_config.body_timeout
+
+    def receive() -> bytes:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError("request body timed out")
+        read = asyncio.wait_for(reader.read(BODY_READ_SIZE), remaining)
+        return asyncio.run_coroutine_threadsafe(read, loop).result()
+
+    def send_continue() -> None:
+        loop.call_soon_threadsafe(writer.write, CONTINUE_RESPONSE)
+
+    pieces = body.stream(parser.buffer, receive, send_continue)
+    try:
+        relay = await asyncio.to_thread(
+            proxy.forward, request, address[0], route, body, pieces
+        )
+        return relayed_response(relay)
+    except UpstreamError as e:
+        access_log.warning(f"Proxying {request.path} failed: {e}")
+        body.sink = None
+        await async_read_body(reader, writer, parser, body)
+        return status_response(e.status)
+
+
+def receive_upload(
+    conn_socket: socket.socket, parser: RequestParser, upload: Upload
+) -> list[UploadFile]:
+    """
+    Streams an upload's body to disk and puts its files in place;
+    whatever was written is deleted if the body does not arrive whole.
+    """
+    try:
+        read_body(conn_socket, parser, upload.body)
+        return upload.finish()
+    except BaseException:
+        upload.abort()
+        raise
+
+
+async def async_receive_upload(
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+    parser: RequestParser,
+    upload: Upload,
+) -> list[UploadFile]:
+    """
+    Coroutine version of receive_upload().
+    """
+    try:
+        await async_read_body(reader, writer, parser, upload.body)
+        return upload.finish()
+    except BaseException:
+        upload.abort()
+        raise
 
-            # Send the HTTP response header and body
-            conn_socket.sendall(response_header.encode())  # header encoded to bytes
-            conn_socket.sendall(response_body)  # response_body is already bytes
 
-        except FileNotFoundError:
-            # If the 'not_found.html' itself doesn't exist, send a basic 404 response
-            response_body = (
-                b"<html><body><h1>404 Not Found</h1></body></html>"  # bytes object
+def record_response(
+    address: tuple[str, int],
+    request: Request,
+    response: Response,
+    length: int,
+    started: float,
+    built: float,
+) -> None:
+    """
+    Logs a response that has just been sent, and counts it in the metrics.
+    """
+    metrics.send.observe(time.perf_counter() - built)
+    metrics.requests.inc(label_value=response.status.split()[0])
+    metrics.bytes_out.inc(length)
+    access_log.access(
+        address[0],
+        f"{request.method} {request.path} {request.version}",
+        int(response.status.split()[0]),
+        length,
+        request.headers.get("referer", ""),
+        request.headers.get("user-agent", ""),
+        time.perf_counter() - started,
+    )
+
+
+def handler(
+    conn_socket: socket.socket, address: tuple[str, int], accepted: float
+) -> None:
+    """
+    Handles the part of the client work-flow that is client-dependent,
+    and thus may be delayed by the user, blocking program flow.
+    Serves successive (possibly pipelined) requests on one connection
+    until the client asks to close, goes idle, or reaches the request limit.
+    A client that is too slow to send a request, or to take the response,
+    is dropped when its header, body or send timeout runs out.
+    accepted is the time.perf_counter() at which the connection was accepted.
+    """
+    parser = RequestParser(server_config.max_header_bytes, server_config.max_headers)
+    timer = ReadTimer()
+    served = 0
+    head_started: float | None = None
+    metrics.connections.inc()
+    metrics.active.inc()
+    try:
+        # Send small responses at once rather than waiting to fill a segment
+        # (asyncio transports set this themselves)
+        conn_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        while True:
+            # Receives the request message from the client, however it is split
+            request = parser.next_request()
+            if request is None:
+                conn_socket.settimeout(timer.next_timeout(parser, served))
+                # The plain socket's shutdown(), which leaves any TLS state alone
+                wake = functools.partial(
+                    socket.socket.shutdown, conn_socket, socket.SHUT_RD
+                )
+                if timer.idle and not idle_connections.add(conn_socket, wake):
+                    break  # the server is stopping
+                try:
+                    data = conn_socket.recv(4096)
+                finally:
+                    idle_connections.remove(conn_socket)
+                if not data:
+                    break  # the client closed the connection
+                if head_started is None:
+                    head_started = time.perf_counter()
+                parser.feed(data)
+                continue
+            timer.request_complete()
+            started = time.perf_counter()
+            metrics.parse.observe(started - (head_started or started))
+            head_started = None
+            served += 1
+            route = proxy.route(request.path)
+            stored: list[UploadFile] | None = None
+            if route is None:
+                upload = start_upload(request)
+                if upload is None:
+                    read_body(conn_socket, parser, RequestBody(request))
+                else:
+                    stored = receive_upload(conn_socket, parser, upload)
+
+            keep_alive = (
+                request.keep_alive
+                and served < server_config.max_keepalive_requests
+                and not draining.is_set()
             )
-            response_header = "HTTP/1.1 404 Not Found\r\n"
-            conn_socket.sendall(response_header.encode())  # encode header to bytes
-            conn_socket.sendall(response_body)  # response_body is already bytes
+
+            # Send the response header and body to the client
+            building = time.perf_counter()
+            if route is not None:
+                response = proxy_response(conn_socket, parser, request, address, route)
+            elif stored is not None:
+                response = upload_response(stored)
+            else:
+                response = build_response(request)
+            conn_socket.settimeout(server_config.send_timeout)
+            built = time.perf_counter()
+            metrics.build.observe(built - building)
+            if served == 1:
+                metrics.first_byte.observe(built - accepted)
+            keep_alive = keep_alive and response.persists(request.version)
+            length = send_response(
+                conn_socket,
+                response,
+                keep_alive,
+                request.version,
+                request.method != "HEAD",
+            )
+            record_response(address, request, response, length, started, built)
+            if not keep_alive:
+                break
+
+    except ParseError as e:
+        access_log.warning(f"Bad request from {address}: {e}")
+        metrics.requests.inc(label_value=e.status.split()[0])
+        conn_socket.settimeout(server_config.send_timeout)
+        try:
+            send_response(conn_socket, error_response(e), False, "HTTP/1.1")
+        except OSError as error:
+            # The client may well have given up on the connection already
+            access_log.debug(f"Could not send the error to {address}: {error}")
+
+    except TimeoutError as e:
+        if timer.idle:
+            access_log.debug(f"Idle connection from {address} timed out")
+        else:
+            access_log.info(f"Slow client {address} timed out: {e}")
+            metrics.requests.inc(label_value="408")
+            conn_socket.settimeout(server_config.send_timeout)
+            try:
+                conn_socket.sendall(closing_page("408 Request Timeout"))
+            except OSError as error:
+                access_log.debug(f"Could not send the 408 to {address}: {error}")
 
     except Exception as e:
-        print(f"Bad request from {address}: {e}")
+        access_log.warning(f"Bad request from {address}: {e}")
 
     finally:
-        # Close the connection socket after sending the response
+        # Close the connection socket after sending the last response
+        metrics.active.dec()
         conn_socket.close()
 
 
-# Main function to start the server
-def main() -> None:
+def limited_handler(
+    conn_socket: socket.socket, address: tuple[str, int], accepted: float
+) -> None:
+    """
+    Runs handler() for a connection counted by the per-IP connection limiter.
+    """
+    try:
+        handler(conn_socket, address, accepted)
+    finally:
+        connection_limiter.release(address[0])
+
+
+async def async_handler(
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+) -> None:
+    """
+    Coroutine version of handler(), run on the event loop for each connection.
+    Waiting on a slow client only suspends this coroutine.
+    """
+    accepted = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    address = writer.get_extra_info("peername")
+    access_log.debug(f"Connection established with {address}")
+    if not connection_limiter.acquire(address[0]):
+        metrics.rejected.inc(label_value="429")
+        access_log.warning(
+            f"Too many connections from {address[0]}, rejecting {address}"
+        )
+        writer.write(TOO_MANY_CONNECTIONS_RESPONSE)
+        writer.close()
+        return
+
+    parser = RequestParser(server_config.max_header_bytes, server_config.max_headers)
+    timer = ReadTimer()
+    served = 0
+    head_started: float | None = None
+    metrics.connections.inc()
+    metrics.active.inc()
+    try:
+        while True:
+            # Receives the request message from the client, however it is split
+            request = parser.next_request()
+            if request is None:
+                timeout = timer.next_timeout(parser, served)
+                wake = functools.partial(loop.call_soon_threadsafe, writer.close)
+                if timer.idle and not idle_connections.add(writer, wake):
+                    break  # the server is stopping
+                try:
+                    data = await asyncio.wait_for(reader.read(4096), timeout)
+                finally:
+                    idle_connections.remove(writer)
+                if not data:
+                    break  # the client closed the connection
+                if head_started is None:
+                    head_started = time.perf_counter()
+                parser.feed(data)
+                continue
+            timer.request_complete()
+            started = time.perf_counter()
+            metrics.parse.observe(started - (head_started or started))
+            head_started = None
+            served += 1
+            route = proxy.route(request.path)
+            stored: list[UploadFile] | None = None
+            if route is None:
+                upload = start_upload(request)
+                if upload is None:
+                    await async_read_body(reader, writer, parser, RequestBody(request))
+                else:
+                    stored = await async_receive_upload(reader, writer, parser, upload)
+
+            keep_alive = (
+                request.keep_alive
+                and served < server_config.max_keepalive_requests
+                and not draining.is_set()
+            )
+
+            # Send the response header and body to the client
+            building = time.perf_counter()
+            if route is not None:
+                response = await async_proxy_response(
+                    reader, writer, parser, request, address, route
+                )
+            elif stored is not None:
+                response = upload_response(stored)
+            else:
+                response = build_response(request)
+            built = time.perf_counter()
+            metrics.build.observe(built - building)
+            if served == 1:
+                metrics.first_byte.observe(built - accepted)
+            keep_alive = keep_alive and response.persists(request.version)
+            length = await async_send_response(
+                writer,
+                response,
+                keep_alive,
+                request.version,
+                request.method != "HEAD",
+            )
+            record_response(address, request, response, length, started, built)
+            if not keep_alive:
+                break
+
+    except ParseError as e:
+        access_log.warning(f"Bad request from {address}: {e}")
+        metrics.requests.inc(label_value=e.status.split()[0])
+        try:
+            await async_send_response(writer, error_response(e), False, "HTTP/1.1")
+        except OSError as error:
+            # The client may well have given up on the connection already
+            access_log.debug(f"Could not send the error to {address}: {error}")
+
+    except (asyncio.TimeoutError, TimeoutError) as e:
+        if timer.idle:
+            access_log.debug(f"Idle connection from {address} timed out")
+        else:
+            access_log.info(f"Slow client {address} timed out: {e}")
+            metrics.requests.inc(label_value="408")
+            try:
+                writer.write(closing_page("408 Request Timeout"))
+            except OSError as error:
+                access_log.debug(f"Could not send the 408 to {address}: {error}")
+
+    except Exception as e:
+        access_log.warning(f"Bad request from {address}: {e}")
+
+    finally:
+        # Close the connection after sending the last response
+        metrics.active.dec()
+        connection_limiter.release(address[0])
+        writer.close()
+
+
+async def serve_async(
+    config: ServerConfig,
+    server_socket: socket.socket,
+    ready: Callable[[], None],
+    reloads: bool,
+) -> None:
+    """
+    Accepts connections on the event loop until a stop signal, then drains.
+    """
+    loop = asyncio.get_running_loop()
+    handshake_timeout = config.header_timeout if tls_context else None
+
+    def stream_protocol() -> asyncio.StreamReaderProtocol:
+        # What asyncio.start_server() uses, to serve each connection with a coroutine
+        return asyncio.StreamReaderProtocol(asyncio.StreamReader(), async_handler)
+
+    # asyncio runs TLS handshakes on the event loop, without blocking it
+    server = await loop.create_server(
+        stream_protocol,
+        sock=server_socket,
+        ssl=tls_context,
+        ssl_handshake_timeout=handshake_timeout,
+    )
+    stopping = asyncio.Event()
+    reloading: set["asyncio.Task[None]"] = set()
+    handed_over = False
+
+    async def reload() -> None:
+        nonlocal handed_over
+        # In a thread, as it waits for the new process to start serving
+        if await asyncio.to_thread(start_replacement, server_socket):
+            handed_over = True
+            stopping.set()
+
+    def request_reload() -> None:
+        # One reload at a time
+        if not reloading:
+            task = loop.create_task(reload())
+            reloading.add(task)
+            task.add_done_callback(reloading.discard)
+
+    loop.add_signal_handler(signal.SIGTERM, stopping.set)
+    loop.add_signal_handler(signal.SIGINT, stopping.set)
+    if reloads:
+        loop.add_signal_handler(signal.SIGHUP, request_reload)
+    ready()
+    await stopping.wait()
+
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+        loop.remove_signal_handler(signum)
+    ignore_stop_signals()
+    # Closing the socket resets the connections queued on it, so unless a
+    # replacement inherited it, those are taken from a duplicate first
+    queued = server_socket.dup()
+    server.close()
+    opening = []
+    while not handed_over:
+        try:
+            # Non-blocking, as asyncio made the (shared) socket
+            conn_socket, _ = queued.accept()
+        except BlockingIOError:
+            break
+        opening.append(
+            loop.connect_accepted_socket(
+                stream_protocol,
+                conn_socket,
+                ssl=tls_context,
+                ssl_handshake_timeout=handshake_timeout,
+            )
+        )
+    queued.close()
+    await asyncio.gather(*opening, return_exceptions=True)
+    # Let the handlers just started register their connections
+    await asyncio.sleep(0)
+    await asyncio.to_thread(drain, config.drain_timeout)
+
+
+def open_server_socket(config: ServerConfig) -> socket.socket:
+    """
+    Creates the listening socket used by every serving mode,
+    or takes over the one a reloading server passed on.
+    """
+    inherited = os.environ.pop(LISTEN_FD_ENV, None)
+    if inherited is not None:
+        server_socket = socket.socket(fileno=int(inherited))
+        if server_socket.getsockname()[1] == config.port:
+            server_socket.listen(config.backlog)
+            print(f"Server took over port {config.port}, listening for connections...")
+            return server_socket
+        server_socket.close()  # the port was changed
+
     server_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_STREAM)
     server_socket.setsockopt(
         socket.SOL_SOCKET, socket.SO_REUSEADDR, 1
     )  # Reuse the socket
-    server_port = 6789
+
+    # Pre-forked workers each bind the same port; the kernel balances accepts
+    if config.processes > 1:
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 
     # Bind the socket to server address and server port
-    server_socket.bind(("0.0.0.0", server_port))
+    server_socket.bind(("0.0.0.0", config.port))
 
-    # Listen for up to 2 connections at a time
-    server_socket.listen(2)
-    print(f"Server started on port {server_port}, listening for connections...")
+    # Let the kernel hold up to `backlog` connections not yet accepted
+    server_socket.listen(config.backlog)
+    print(f"Server started on port {config.port}, listening for connections...")
+    return server_socket
 
-    threads = []
-    try:
+
+def tls_handshakes(
+    dispatch: Callable[[socket.socket, tuple[str, int], float], None],
+) -> HandshakeReactor | None:
+    """
+    The thread that completes the TLS handshake of each accepted connection,
+    or None when serving plain HTTP. Connections whose handshake is done are
+    passed to dispatch() on another thread: dispatch may wait (the pool's
+    overload policy), which would hold up every other pending handshake.
+    """
+    if tls_context is None:
+        return None
+    handshaken: "queue.SimpleQueue[tuple[socket.socket, tuple[str, int], float]]" = (
+        queue.SimpleQueue()
+    )
+
+    def failed(address: tuple[str, int], error: str) -> None:
+        connection_limiter.release(address[0])
+        access_log.info(f"{error} with {address}")
+
+    def dispatcher() -> None:
         while True:
-            # Accept new client connections
-            conn_socket, client_address = server_socket.accept()
-            print(f"Connection established with {client_address}")
+            conn_socket, address, accepted = handshaken.get()
+            try:
+                dispatch(conn_socket, address, accepted)
+            except Exception as e:
+                conn_socket.close()
+                failed(address, f"could not hand over connection: {e}")
 
-            # Start a new thread to handle the client
-            new_thread = threading.Thread(
-                target=handler, args=(conn_socket, client_address)
-            )
-            new_thread.start()
+    def ready(
+        conn_socket: socket.socket, address: tuple[str, int], accepted: float
+    ) -> None:
+        handshaken.put((conn_socket, address, accepted))
+
+    threading.Thread(target=dispatcher, daemon=True).start()
+    return HandshakeReactor(tls_context, server_config.header_timeout, ready, failed)
+
+
+def start_handler(
+    conn_socket: socket.socket, address: tuple[str, int], accepted: float
+) -> None:
+    # A daemon, so a connection still open after the drain does not keep
+    # the process alive
+    threading.Thread(
+        target=limited_handler, args=(conn_socket, address, accepted), daemon=True
+    ).start()
 
-            # Keep track of threads
-            threads.append(new_thread)
 
+def accept_connections(
+    server_socket: socket.socket,
+    dispatch: Callable[[socket.socket, tuple[str, int], float], None],
+) -> None:
+    """
+    Accepts connections and passes each one to dispatch (with TLS, once
+    its handshake is done) until a stop signal. The connections already
+    waiting in the kernel are then accepted too, rather than reset when
+    the socket closes, unless a replacement process inherited the socket.
+    The socket's blocking mode is shared with any process it is passed to,
+    so it is never changed; select() tells when a connection is waiting.
+    """
+    handshakes = tls_handshakes(dispatch)
+
+    def accept() -> None:
+        try:
+            conn_socket, client_address = server_socket.accept()
+        except BlockingIOError:
+            return  # another process sharing the socket took it
+        accepted = time.perf_counter()
+        access_log.debug(f"Connection established with {client_address}")
+        if not connection_limiter.acquire(client_address[0]):
+            reject(conn_socket, client_address, TOO_MANY_CONNECTIONS_RESPONSE)
+        elif handshakes is not None:
+            handshakes.submit(conn_socket, client_address, accepted)
+        else:
+            dispatch(conn_socket, client_address, accepted)
+
+    try:
+        while True:
+            # Accept new client connections
+            select.select([server_socket], [], [])
+            accept()
+
+    except HandedOver:
+        pass  # the replacement accepts the waiting connections
+    except KeyboardInterrupt:
+        while select.select([server_socket], [], [], 0)[0]:
+            accept()
     except Exception as e:
         print("Exception occurred (maybe you killed the server)")
         print(e)
@@ -108,6 +1837,680 @@ def main() -> None:
         server_socket.close()
 
 
+def serve_threaded(config: ServerConfig, server_socket: socket.socket) -> None:
+    """
+    Starts a new thread to handle each connection.
+    """
+    accept_connections(server_socket, start_handler)
+
+
+def pool_worker(
+    connections: "queue.Queue[tuple[socket.socket, tuple[str, int], float]]",
+) -> None:
+    """
+    Serves connections from the shared queue, one at a time, forever.
+    """
+    while True:
+        conn_socket, client_address, accepted = connections.get()
+        try:
+            limited_handler(conn_socket, client_address, accepted)
+        except Exception as e:
+            # Nothing replaces a worker, so one connection must not end it
+            access_log.warning(f"Error serving {client_address}: {e!r}")
+            conn_socket.close()
+
+
+def reject(
+    conn_socket: socket.socket, address: tuple[str, int], response: bytes
+) -> None:
+    """
+    Turns away a connection the server has no room for,
+    without letting a client that does not read hold up the accept loop.
+    """
+    status_line = response.split(b"\r\n")[0].decode()
+    access_log.warning(f"Rejecting {address}: {status_line}")
+    metrics.rejected.inc(label_value=status_line.split()[1])
+    try:
+        conn_socket.setblocking(False)
+        conn_socket.send(response)
+    except OSError:
+        pass
+    finally:
+        conn_socket.close()
+
+
+def enqueue(
+    connections: "queue.Queue[tuple[socket.socket, tuple[str, int], float]]",
+    config: ServerConfig,
+    conn_socket: socket.socket,
+    client_address: tuple[str, int],
+    accepted: float,
+) -> None:
+    """
+    Queues a connection for the worker pool,
+    applying the overload policy if every queue slot is taken.
+    """
+    try:
+        if config.overload == "block":
+            connections.put((conn_socket, client_address, accepted))
+        elif config.overload == "queue":
+            connections.put(
+                (conn_socket, client_address, accepted),
+                timeout=config.queue_timeout,
+            )
+        else:
+            connections.put_nowait((conn_socket, client_address, accepted))
+    except queue.Full:
+        connection_limiter.release(client_address[0])
+        reject(conn_socket, client_address, OVERLOADED_RESPONSE)
+
+
+def serve_pool(config: ServerConfig, server_socket: socket.socket) -> None:
+    """
+    Queues connections for a fixed pool of worker threads
+    (with TLS, once their handshake is done, so workers never wait on one).
+    """
+    connections: "queue.Queue[tuple[socket.socket, tuple[str, int], float]]" = (
+        queue.Queue(maxsize=config.queue_size)
+    )
+    for _ in range(config.workers):
+        threading.Thread(target=pool_worker, args=(connections,), daemon=True).start()
+    accept_connections(server_socket, functools.partial(enqueue, connections, config))
+
+
+def report_ready() -> None:
+    """
+    Tells the process this one replaces (see start_replacement()) that it
+    is serving now, so the old one can drain and exit.
+    """
+    fd = os.environ.pop(READY_FD_ENV, None)
+    if fd is None:
+        return
+    try:
+        os.write(int(fd), b"\n")
+    except OSError:
+        pass  # the old process is gone already
+    finally:
+        os.close(int(fd))
+
+
+def start_replacement(server_socket: socket.socket | None) -> bool:
+    """
+    Starts a new server process from the same command line, so it loads
+    the current code and options, and waits until it is serving. It
+    inherits server_socket, if given, so no connection is refused
+    meanwhile. Returns False, leaving this process in charge, if it fails.
+    """
+    print("Reloading: starting a new server process")
+    read_end, write_end = os.pipe()
+    env = dict(os.environ)
+    env[READY_FD_ENV] = str(write_end)
+    fds = [write_end]
+    if server_socket is not None:
+        env[LISTEN_FD_ENV] = str(server_socket.fileno())
+        fds.append(server_socket.fileno())
+    try:
+        replacement = subprocess.Popen(
+            [sys.executable, *sys.argv], env=env, pass_fds=fds
+        )
+    except OSError as e:
+        os.close(read_end)
+        print(f"Reload failed: {e}")
+        return False
+    finally:
+        os.close(write_end)
+
+    # A byte when it is serving; end of file if it exits first
+    with open(read_end, "rb", buffering=0) as pipe:
+        readable, _, _ = select.select([pipe], [], [], REPLACEMENT_TIMEOUT)
+        serving = bool(readable) and pipe.read(1) != b""
+    if not serving:
+        print("Reload failed: the new server process did not start serving")
+        replacement.kill()
+        replacement.wait()
+        return False
+    print(f"Reloaded: process {replacement.pid} is serving, draining this one")
+    return True
+
+
+class HandedOver(KeyboardInterrupt):
+    """
+    Stops the accept loop of a server whose listening socket now belongs
+    to a replacement process.
+    """
+
+
+def ignore_stop_signals() -> None:
+    """
+    Once stopping, further SIGTERM and SIGHUP are ignored,
+    while a second SIGINT (Ctrl-C) ends the process at once.
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+
+def stop_serving(
+    server_socket: socket.socket | None, signum: int, frame: FrameType | None
+) -> None:
+    """
+    Main thread signal handler: SIGTERM and SIGINT stop the accept loop
+    (with KeyboardInterrupt), and SIGHUP does too (with HandedOver), once
+    a replacement process is serving (see start_replacement()).
+    """
+    if signum == signal.SIGHUP:
+        # Further SIGHUPs are ignored while this one is handled
+        previous = signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        if not start_replacement(server_socket):
+            signal.signal(signal.SIGHUP, previous)
+            return
+        ignore_stop_signals()
+        raise HandedOver
+    ignore_stop_signals()
+    raise KeyboardInterrupt
+
+
+def drain(timeout: float) -> None:
+    """
+    Lets the open connections finish the requests in progress, for up to
+    timeout seconds. Idle ones are closed at once, and persistent ones
+    after their current response.
+    """
+    draining.set()
+    idle_connections.close_all()
+    remaining = connection_limiter.wait_closed(0)
+    if remaining:
+        print(f"Draining {remaining} connections (up to {timeout:g}s)")
+        remaining = connection_limiter.wait_closed(timeout)
+        if remaining:
+            print(f"Drain timed out, closing {remaining} connections")
+    print("Server stopped")
+    access_log.close()
+
+
+def parse_args() -> ServerConfig:
+    defaults = ServerConfig()
+    parser = argparse.ArgumentParser(description="A simple Web server.")
+    parser.add_argument("--port", type=int, default=defaults.port)
+    parser.add_argument(
+        "--mode",
+        choices=("thread", "async", "pool"),
+        default=defaults.mode,
+        help="one thread per connection, one asyncio event loop, or a worker pool",
+    )
+    parser.add_argument(
+        "--backlog",
+        type=int,
+        default=defaults.backlog,
+        help="kernel listen queue length",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=defaults.workers,
+        help="worker threads in pool mode",
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=defaults.queue_size,
+        help="accepted connections waiting",
+    )
+    parser.add_argument(
+        "--overload",
+        choices=("queue", "shed", "block"),
+        default=defaults.overload,
+        help="what to do with a connection when the queue is full",
+    )
+    parser.add_argument(
+        "--queue-timeout",
+        type=float,
+        default=defaults.queue_timeout,
+        help="seconds the queue policy waits for room before shedding",
+    )
+    parser.add_argument(
+        "--cache-bytes",
+        type=int,
+        default=defaults.cache_bytes,
+        help="memory budget for cached file contents (0 disables the cache)",
+    )
+    parser.add_argument(
+        "--cache-entry-bytes",
+        type=int,
+        default=defaults.cache_entry_bytes,
+        help="files larger than this are never cached",
+    )
+    parser.add_argument(
+        "--sendfile-threshold",
+        type=int,
+        default=defaults.sendfile_threshold,
+        help="files at least this large are sent with sendfile, not from memory",
+    )
+    parser.add_argument(
+        "--keepalive-timeout",
+        type=float,
+        default=defaults.keepalive_timeout,
+        help="seconds an idle persistent connection waits for its next request",
+    )
+    parser.add_argument(
+        "--max-keepalive-requests",
+        type=int,
+        default=defaults.max_keepalive_requests,
+        help="requests served on one connection before it is closed",
+    )
+    parser.add_argument(
+        "--max-header-bytes",
+        type=int,
+        default=defaults.max_header_bytes,
+        help="largest request head accepted (431 beyond it)",
+    )
+    parser.add_argument(
+        "--max-headers",
+        type=int,
+        default=defaults.max_headers,
+        help="most header fields accepted in one request (431 beyond it)",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=defaults.processes,
+        help="pre-forked worker processes sharing the port (0: one per CPU core)",
+    )
+    parser.add_argument(
+        "--last-modified",
+        action="store_true",
+        help="also send Last-Modified (mtime) validators",
+    )
+    parser.add_argument(
+        "--compress-min-bytes",
+        type=int,
+        default=defaults.compress_min_bytes,
+        help="smaller files are not worth compressing",
+    )
+    parser.add_argument(
+        "--compress-cache-bytes",
+        type=int,
+        default=defaults.compress_cache_bytes,
+        help="memory budget for cached compressed responses",
+    )
+    parser.add_argument(
+        "--header-timeout",
+        type=float,
+        default=defaults.header_timeout,
+        help="seconds a client has to send a complete request head (408 after)",
+    )
+    parser.add_argument(
+        "--body-timeout",
+        type=float,
+        default=defaults.body_timeout,
+        help="seconds a client has to send a complete request body",
+    )
+    parser.add_argument(
+        "--send-timeout",
+        type=float,
+        default=defaults.send_timeout,
+        help="seconds a response may wait on a client that does not read",
+    )
+    parser.add_argument(
+        "--max-connections-per-ip",
+        type=int,
+        default=defaults.max_connections_per_ip,
+        help="open connections allowed from one client IP (0: no limit)",
+    )
+    parser.add_argument(
+        "--access-log",
+        default=defaults.access_log,
+        help='access log file ("-" for stdout, "stderr" for stderr)',
+    )
+    parser.add_argument("--log-format", choices=FORMATS, default=defaults.log_format)
+    parser.add_argument(
+        "--log-level",
+        choices=list(LEVELS),
+        default=defaults.log_level,
+        help="threshold for diagnostic messages, which go to stderr",
+    )
+    parser.add_argument(
+        "--log-sample",
+        type=float,
+        default=defaults.log_sample,
+        help="fraction of successful requests to log (errors are always logged)",
+    )
+    parser.add_argument(
+        "--log-max-bytes",
+        type=int,
+        default=defaults.log_max_bytes,
+        help="rotate the access log at this size (0: never)",
+    )
+    parser.add_argument(
+        "--log-backups",
+        type=int,
+        default=defaults.log_backups,
+        help="rotated access logs to keep",
+    )
+    parser.add_argument(
+        "--metrics-path",
+        default=defaults.metrics_path,
+        help="serve Prometheus metrics at this path, e.g. /metrics (default: off)",
+    )
+    parser.add_argument(
+        "--directory-listing",
+        action="store_true",
+        help="answer requests for a directory with a list of its files",
+    )
+    parser.add_argument(
+        "--doc-root",
+        default=defaults.doc_root,
+        help="directory that request paths are relative to",
+    )
+    parser.add_argument(
+        "--path-cache-ttl",
+        type=float,
+        default=defaults.path_cache_ttl,
+        help="seconds a resolved request path is remembered",
+    )
+    parser.add_argument(
+        "--negative-cache-ttl",
+        type=float,
+        default=defaults.negative_cache_ttl,
+        help="seconds a missing request path is remembered",
+    )
+    parser.add_argument(
+        "--mmap-threshold",
+        type=int,
+        default=defaults.mmap_threshold,
+        help="send files of at least this many bytes from shared memory "
+        "mappings instead of sendfile or reads (0: never)",
+    )
+    parser.add_argument(
+        "--mmap-max-files",
+        type=int,
+        default=defaults.mmap_max_files,
+        help="most files kept mapped with --mmap-threshold (least recently "
+        "used ones are let go first)",
+    )
+    parser.add_argument(
+        "--upload-dir",
+        default=defaults.upload_dir,
+        help="store files sent with PUT or POST in this directory (default: off)",
+    )
+    parser.add_argument(
+        "--upload-path",
+        default=defaults.upload_path,
+        help="URL path under which uploads are accepted",
+    )
+    parser.add_argument(
+        "--max-upload-bytes",
+        type=int,
+        default=defaults.max_upload_bytes,
+        help="largest request body accepted for an upload (413 beyond it)",
+    )
+    parser.add_argument(
+        "--proxy",
+        action="append",
+        default=[],
+        metavar="PREFIX=URL[,URL...]",
+        help="forward requests under PREFIX to these upstream servers "
+        "(repeatable), e.g. /api/=http://127.0.0.1:8001/,http://127.0.0.1:8002/",
+    )
+    parser.add_argument(
+        "--proxy-timeout",
+        type=float,
+        default=defaults.proxy_timeout,
+        help="seconds to wait on an upstream server (504 after)",
+    )
+    parser.add_argument(
+        "--proxy-max-idle",
+        type=int,
+        default=defaults.proxy_max_idle,
+        help="idle keep-alive connections kept open per upstream",
+    )
+    parser.add_argument(
+        "--health-check-path",
+        default=defaults.health_check_path,
+        help="path requested from each upstream to check it is up",
+    )
+    parser.add_argument(
+        "--health-check-interval",
+        type=float,
+        default=defaults.health_check_interval,
+        help="seconds between upstream health checks (0: never)",
+    )
+    parser.add_argument(
+        "--tls-cert",
+        default=defaults.tls_cert,
+        metavar="FILE",
+        help="serve HTTPS with this PEM certificate chain (default: plain HTTP)",
+    )
+    parser.add_argument(
+        "--tls-key",
+        default=defaults.tls_key,
+        metavar="FILE",
+        help="PEM private key of --tls-cert, if not in the same file",
+    )
+    parser.add_argument(
+        "--tls-tickets",
+        type=int,
+        default=defaults.tls_tickets,
+        help="session tickets sent after a full TLS handshake, for resumption",
+    )
+    parser.add_argument(
+        "--drain-timeout",
+        type=float,
+        default=defaults.drain_timeout,
+        help="seconds open connections get to finish when the server stops",
+    )
+    args = parser.parse_args()
+    for spec in args.proxy:
+        try:
+            parse_route(spec)
+        except ValueError as e:
+            parser.error(str(e))
+    if args.tls_key and not args.tls_cert:
+        parser.error("--tls-key needs --tls-cert")
+    if args.tls_cert:
+        try:
+            server_context(args.tls_cert, args.tls_key, args.tls_tickets)
+        except (OSError, ValueError) as e:
+            parser.error(f"cannot load the TLS certificate: {e}")
+    return ServerConfig(
+        port=args.port,
+        mode=args.mode,
+        backlog=args.backlog,
+        workers=args.workers,
+        queue_size=args.queue_size,
+        overload=args.overload,
+        queue_timeout=args.queue_timeout,
+        cache_bytes=args.cache_bytes,
+        cache_entry_bytes=args.cache_entry_bytes,
+        sendfile_threshold=args.sendfile_threshold,
+        keepalive_timeout=args.keepalive_timeout,
+        max_keepalive_requests=args.max_keepalive_requests,
+        max_header_bytes=args.max_header_bytes,
+        max_headers=args.max_headers,
+        processes=args.processes or os.cpu_count() or 1,
+        last_modified=args.last_modified,
+        compress_min_bytes=args.compress_min_bytes,
+        compress_cache_bytes=args.compress_cache_bytes,
+        header_timeout=args.header_timeout,
+        body_timeout=args.body_timeout,
+        send_timeout=args.send_timeout,
+        max_connections_per_ip=args.max_connections_per_ip,
+        access_log=args.access_log,
+        log_format=args.log_format,
+        log_level=args.log_level,
+        log_sample=args.log_sample,
+        log_max_bytes=args.log_max_bytes,
+        log_backups=args.log_backups,
+        metrics_path=args.metrics_path,
+        directory_listing=args.directory_listing,
+        doc_root=args.doc_root,
+        path_cache_ttl=args.path_cache_ttl,
+        negative_cache_ttl=args.negative_cache_ttl,
+        mmap_threshold=args.mmap_threshold,
+        mmap_max_files=args.mmap_max_files,
+        upload_dir=args.upload_dir,
+        upload_path=args.upload_path,
+        max_upload_bytes=args.max_upload_bytes,
+        proxy=args.proxy,
+        proxy_timeout=args.proxy_timeout,
+        proxy_max_idle=args.proxy_max_idle,
+        health_check_path=args.health_check_path,
+        health_check_interval=args.health_check_interval,
+        tls_cert=args.tls_cert,
+        tls_key=args.tls_key,
+        tls_tickets=args.tls_tickets,
+        drain_timeout=args.drain_timeout,
+    )
+
+
+def serve(
+    config: ServerConfig, ready: Callable[[], None], reloads: bool = True
+) -> None:
+    """
+    Runs one server process in the configured mode until a stop signal,
+    then drains it. ready() is called once it is serving. With reloads,
+    SIGHUP replaces the process with a new one (see start_replacement()).
+    """
+    global server_config, file_cache, compression_cache, connection_limiter
+    global access_log, path_resolver, mapped_files, proxy, tls_context
+    server_config = config
+    if config.tls_cert and tls_context is None:
+        tls_context = server_context(
+            config.tls_cert, config.tls_key, config.tls_tickets
+        )
+    path_resolver = PathResolver(
+        config.doc_root, config.path_cache_ttl, config.negative_cache_ttl
+    )
+    access_log = AccessLog(
+        config.access_log,
+        config.log_format,
+        config.log_level,
+        config.log_sample,
+        config.log_max_bytes,
+        config.log_backups,
+    )
+    connection_limiter = ConnectionLimiter(config.max_connections_per_ip)
+    file_cache = FileCache(config.cache_bytes, config.cache_entry_bytes)
+    compression_cache = CompressionCache(config.compress_cache_bytes)
+    mapped_files = MappedFileStore(config.mmap_max_files)
+    proxy = ReverseProxy(
+        [parse_route(spec) for spec in config.proxy],
+        config.proxy_timeout,
+        config.proxy_max_idle,
+        config.health_check_path,
+        config.health_check_interval,
+        lambda text: access_log.warning(text),
+        "https" if tls_context is not None else "http",
+    )
+    proxy.start_health_checks()
+    server_socket = open_server_socket(config)
+    if not reloads:
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    if config.mode == "async":
+        asyncio.run(serve_async(config, server_socket, ready, reloads))
+        return
+
+    stop = functools.partial(stop_serving, server_socket)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    if reloads:
+        signal.signal(signal.SIGHUP, stop)
+    ready()
+    if config.mode == "pool":
+        serve_pool(config, server_socket)
+    else:
+        serve_threaded(config, server_socket)
+    drain(config.drain_timeout)
+
+
+def run_worker(config: ServerConfig, ready: Callable[[], None]) -> None:
+    """
+    Entry point of a pre-forked worker process.
+    """
+    # Forked workers inherit the supervisor's handlers until serve() sets theirs
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    try:
+        serve(config, ready, reloads=False)
+    except KeyboardInterrupt:
+        pass  # the supervisor reports the interrupt
+
+
+def supervise(config: ServerConfig) -> None:
+    """
+    Pre-fork mode: runs config.processes copies of the server, each with its
+    own SO_REUSEPORT listening socket on the same port, so the kernel spreads
+    connections across processes (and cores). Restarts workers that die,
+    and drains them all when the supervisor is interrupted or terminated,
+    or replaced by a new one on SIGHUP.
+    """
+    stop = functools.partial(stop_serving, None)
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+        signal.signal(signum, stop)
+    workers: dict[int, multiprocessing.Process] = {}
+    started: dict[int, float] = {}
+    # Released by each worker once it is listening
+    listening = multiprocessing.Semaphore(0)
+
+    def start_worker() -> None:
+        worker = multiprocessing.Process(
+            target=run_worker, args=(config, listening.release), daemon=True
+        )
+        worker.start()
+        workers[worker.sentinel] = worker
+        started[worker.sentinel] = time.monotonic()
+
+    print(f"Starting {config.processes} worker processes")
+    for _ in range(config.processes):
+        start_worker()
+    try:
+        deadline = time.monotonic() + REPLACEMENT_TIMEOUT
+        if all(
+            listening.acquire(timeout=max(0.0, deadline - time.monotonic()))
+            for _ in range(config.processes)
+        ):
+            report_ready()
+        while True:
+            for sentinel in multiprocessing.connection.wait(list(workers)):
+                assert isinstance(sentinel, int)
+                worker = workers.pop(sentinel)
+                lifetime = time.monotonic() - started.pop(sentinel)
+                worker.join()
+                print(f"Worker {worker.pid} exited ({worker.exitcode}), restarting")
+                # Do not spin if workers die as soon as they start
+                if lifetime < 1.0:
+                    time.sleep(1.0)
+                start_worker()
+
+    except KeyboardInterrupt:
+        print("Stopping worker processes")
+    finally:
+        # SIGTERM makes each worker drain its connections
+        for worker in workers.values():
+            worker.terminate()
+        deadline = time.monotonic() + config.drain_timeout + 1.0
+        for worker in workers.values():
+            worker.join(max(0.0, deadline - time.monotonic()))
+            if worker.is_alive():
+                worker.kill()
+                worker.join()
+
+
+# Main function to start the server
+def main() -> None:
+    global tls_context
+    config = parse_args()
+    if config.tls_cert:
+        # Before forking, so every worker issues and accepts the same tickets
+        tls_context = server_context(
+            config.tls_cert, config.tls_key, config.tls_tickets
+        )
+    if config.processes > 1:
+        supervise(config)
+    else:
+        serve(config, report_ready)
+
+
 # Run the server if this script is executed directly
 if __name__ == "__main__":
     main()